@@ -4,31 +4,173 @@ Determines numbers of bands that can be used, compatible with the
 degenerate subspaces.
 
 Partly adapted from degeneracy_check.f90 of BerkeleyGW v2.1.
+
+Usage: python3 degeneracy_check.py prefix [outdir] [--tol TOL [TOL ...]] [--json FILE]
 """
-import sys
+import json
+import argparse
 import numpy as np
-from qe_parse_energy import parse_energy
+from qe_parse_energy import iterparse_ks_energies, parse_header, text_to_array
 
 hartree_to_ev = lambda x: float(x) * 27.21138602
 degeneracy_tol = 1E-6 # Ry
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('Usage: python3 degeneracy_check.py prefix outdir')
-        raise KeyError("Wrong input")
-
-    seedname = sys.argv[1]
-    if len(sys.argv) == 2:
-        outdir = 'temp'
-    elif len(sys.argv) == 3:
-        outdir = sys.argv[2]
+def band_statistics(energy):
+    """
+    Compute the band-wise statistics used by the degeneracy check.
+    energy has shape (nbnd, nk), or (nbnd, nk, 2) for LSDA as returned by
+    parse_energy. Returns a dict of arrays with a leading spin axis:
+    emin, emax, ik_min, ik_max with shape (nspin, nbnd), and gap, ik_gap with
+    shape (nspin, nbnd-1), where gap[:, ib] is the minimum over k of
+    energy[ib+1] - energy[ib] and ik_* are the k indices where each occurs.
+    """
+    if energy.ndim == 2:
+        e = energy[np.newaxis, :, :]
     else:
-        raise ValueError
+        e = np.moveaxis(energy, 2, 0)
+    diff = np.diff(e, axis=1)
+    return {
+        'emin': e.min(axis=2),
+        'emax': e.max(axis=2),
+        'ik_min': e.argmin(axis=2),
+        'ik_max': e.argmax(axis=2),
+        'gap': diff.min(axis=2),
+        'ik_gap': diff.argmin(axis=2),
+    }
+
+class BandStatisticsReducer:
+    """
+    Running version of band_statistics that is updated one k point at a time.
+    Keeps O(nbnd) state, so the full energy array is never needed.
+    """
+    def __init__(self, nspin, nbnd):
+        self.nk = 0
+        self.emin = np.full((nspin, nbnd), np.inf)
+        self.emax = np.full((nspin, nbnd), -np.inf)
+        self.ik_min = np.zeros((nspin, nbnd), dtype=int)
+        self.ik_max = np.zeros((nspin, nbnd), dtype=int)
+        self.gap = np.full((nspin, nbnd - 1), np.inf)
+        self.ik_gap = np.zeros((nspin, nbnd - 1), dtype=int)
+
+    def update(self, e):
+        """Add the energies of the next k point, with shape (nspin, nbnd)."""
+        ik = self.nk
+        # Strict comparisons keep the first k index, as argmin and argmax do
+        mask = e < self.emin
+        self.emin[mask] = e[mask]
+        self.ik_min[mask] = ik
+        mask = e > self.emax
+        self.emax[mask] = e[mask]
+        self.ik_max[mask] = ik
+        diff = e[:, 1:] - e[:, :-1]
+        mask = diff < self.gap
+        self.gap[mask] = diff[mask]
+        self.ik_gap[mask] = ik
+        self.nk += 1
+
+    def result(self):
+        return {
+            'emin': self.emin,
+            'emax': self.emax,
+            'ik_min': self.ik_min,
+            'ik_max': self.ik_max,
+            'gap': self.gap,
+            'ik_gap': self.ik_gap,
+        }
+
+def stream_band_statistics(xmlfile):
+    """
+    Compute band_statistics in a single streaming pass over xmlfile, without
+    storing the energies. Returns (is_lsda, nbnd, nk, stats).
+    """
+    reducer = None
+    for header, node in iterparse_ks_energies(xmlfile):
+        if reducer is None:
+            is_lsda, nbnd, nk = parse_header(header)
+            nspin = 2 if is_lsda else 1
+            reducer = BandStatisticsReducer(nspin, nbnd // nspin)
+        # Eigenvalues of spin up come before those of spin down
+        e = text_to_array(node.find('eigenvalues').text).reshape(nspin, -1)
+        reducer.update(e)
+    if reducer is None:
+        raise ValueError(f"No ks_energies found in {xmlfile}")
+    assert reducer.nk == nk
+    return is_lsda, nbnd, nk, reducer.result()
+
+def degeneracy_allowed_bands(stats, tol):
+    """
+    Return, for each spin, the 1-based numbers of bands nb such that bands nb
+    and nb+1 are never closer than tol.
+    """
+    return [list(np.nonzero(gap > tol)[0] + 1) for gap in stats['gap']]
+
+def degeneracy_report(stats, tolerances):
+    """Return the results of the degeneracy check as a JSON-serializable dict (energies in eV)."""
+    to_ev = lambda x: (np.asarray(x) * hartree_to_ev(1.0)).tolist()
+    nspin = stats['emin'].shape[0]
+    spins = []
+    for ispin in range(nspin):
+        spins.append({
+            'band_min': to_ev(stats['emin'][ispin]),
+            'band_max': to_ev(stats['emax'][ispin]),
+            'ik_band_min': stats['ik_min'][ispin].tolist(),
+            'ik_band_max': stats['ik_max'][ispin].tolist(),
+            'gap_min': to_ev(stats['gap'][ispin]),
+            'ik_gap_min': stats['ik_gap'][ispin].tolist(),
+            'degeneracy_allowed': [
+                {'tolerance': tol, 'nbnd': [int(nb) for nb in degeneracy_allowed_bands(stats, tol)[ispin]]}
+                for tol in tolerances
+            ],
+        })
+    return {'units': 'eV', 'spins': spins}
+
+def print_report(stats, tolerances):
+    nspin, nbnd = stats['emin'].shape
+    for ispin in range(nspin):
+        emin = stats['emin'][ispin]
+        emax = stats['emax'][ispin]
+        gap = stats['gap'][ispin]
+        if nspin == 2:
+            print()
+            print(f"==== Spin {ispin + 1} ====")
+
+        for tol in tolerances:
+            print()
+            if len(tolerances) == 1:
+                print('== Degeneracy-allowed numbers of bands ==')
+            else:
+                print(f'== Degeneracy-allowed numbers of bands (tolerance {tol:.1E}) ==')
+            print('number of bands / Max energy of the included bands / Min energy of the excluded bands')
+            for nb in degeneracy_allowed_bands(stats, tol)[ispin]:
+                ib = nb - 1
+                print(f"{ib + 1:8d}", end="")
+                print(f"{hartree_to_ev(emax[ib]):10.2f} eV", end="")
+                print(f"{hartree_to_ev(emin[ib+1]):10.2f} eV", end="")
+                print(f"   (gap = {hartree_to_ev(gap[ib]):6.2f} eV)")
+            print(f"Note: cannot assess whether or not the highest band {nbnd} is degenerate.")
+
+        print()
+        print(f"Minimum energy of the highest band = {hartree_to_ev(emin[-1])} eV")
+
+        print()
+        print(f"Minimum / Maximum energy of the bands [eV]")
+        for ib in range(nbnd):
+            print(f"{ib+1:5d}  {hartree_to_ev(emin[ib]):10.5f}   ~ {hartree_to_ev(emax[ib]):10.5f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check band degeneracy over all k points')
+    parser.add_argument('prefix')
+    parser.add_argument('outdir', nargs='?', default='temp')
+    parser.add_argument('--tol', type=float, nargs='+', default=[degeneracy_tol],
+                        help=f'Degeneracy tolerances, in the units of the xml file (default: {degeneracy_tol})')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    seedname = args.prefix
+    outdir = args.outdir
     xmlfile = outdir + '/' + seedname + '.xml'
 
-    is_lsda, nbnd, nk, weight, energy, occupations, xk = parse_energy(xmlfile)
-    if is_lsda:
-        raise NotImplementedError
+    is_lsda, nbnd, nk, stats = stream_band_statistics(xmlfile)
     nspin = 2 if is_lsda else 1
 
     print('Reading eigenvalues from file', xmlfile)
@@ -36,33 +178,12 @@ if __name__ == '__main__':
     print(f"Number of bands:{nbnd:16d}")
     print(f"Number of k-points:{nk:13d}")
 
-    no_degeneracy = [False] * nbnd
-    gap_list = [0.0] * nbnd
-
-    for ib in range(nbnd - 1):
-        gap = np.min(energy[ib+1, :] - energy[ib, :])
-        gap_list[ib] = gap
-        if gap > degeneracy_tol:
-            no_degeneracy[ib] = True
-
-
-    print()
-    print('== Degeneracy-allowed numbers of bands ==')
-    print('number of bands / Max energy of the included bands / Min energy of the excluded bands')
-    for ib in range(nbnd):
-        if no_degeneracy[ib]:
-            print(f"{ib + 1:8d}", end="")
-            print(f"{hartree_to_ev(np.amax(energy[ib, :])):10.2f} eV", end="")
-            print(f"{hartree_to_ev(np.amin(energy[ib+1, :])):10.2f} eV", end="")
-            print(f"   (gap = {hartree_to_ev(gap_list[ib]):6.2f} eV)")
-    print(f"Note: cannot assess whether or not the highest band {nbnd} is degenerate.")
-
-    print()
-    print(f"Minimum energy of the highest band = {hartree_to_ev(np.amin(energy[-1, :]))} eV")
-
-    print()
-    print(f"Minimum / Maximum energy of the bands [eV]")
-    for ib in range(nbnd):
-        emin = hartree_to_ev(np.amin(energy[ib, :]))
-        emax = hartree_to_ev(np.amax(energy[ib, :]))
-        print(f"{ib+1:5d}  {emin:10.5f}   ~ {emax:10.5f}")
+    print_report(stats, args.tol)
+
+    if args.json is not None:
+        report = {'xmlfile': xmlfile, 'nspin': nspin, 'nbnd': nbnd, 'nk': nk}
+        report.update(degeneracy_report(stats, args.tol))
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+        print()
+        print(f"Results written to {args.json}")
@@ -6,7 +6,8 @@
 # 14/03/2018 - Detect if SOC is included in the calculation - Samuel Ponce
 #
 # Usage:
-#   epw_pp.py [prefix] [--outdir OUTDIR] [--dyndir DYNDIR]
+#   epw_pp.py [prefix] [--outdir OUTDIR] [--dyndir DYNDIR] [--jobs JOBS]
+#             [--stage-mode {copy,hardlink,reflink,symlink,move}] [--checksum] [--verify] [--dry-run]
 #
 # Arguments:
 #   prefix              Prefix used for PH calculations (e.g. diam)
@@ -15,6 +16,19 @@
 # Options:
 #   --outdir OUTDIR     Output directory containing PH results (default: temp)
 #   --dyndir DYNDIR     Directory containing dynamical matrices (default: dyn_dir)
+#   --jobs JOBS         Number of files copied concurrently (default: 4)
+#   --stage-mode MODE   How the dyn, phsave and dvscf files are put in save/ (default: copy)
+#                       copy: copy the data
+#                       reflink: copy-on-write clone, falls back to copy
+#                       hardlink: falls back to reflink, then copy
+#                       symlink: falls back to hardlink, reflink, then copy
+#                       move: rename, falls back to reflink or copy and removing the source
+#   --checksum          Also store checksums in the manifest, and compare checksums in --verify
+#   --verify            Only check the files in save/ against the manifest and the sources
+#   --dry-run           Only print the files that would be removed, merged and staged
+#
+# The staged files are recorded in save/.epw_pp_manifest.json. When the script
+# is run again, files that were already staged and did not change are skipped.
 #
 # Examples:
 #   epw_pp.py diam
@@ -23,33 +37,43 @@
 #
 import sys
 import os
+import glob
+import time
+import json
+import fcntl
+import shutil
+import hashlib
 import argparse
-from xml.dom import minidom
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import xml.etree.ElementTree as ET
 
 # Return the number of q-points in the IBZ
 def get_nqpt(prefix, outdir):
     fname = f'{outdir}/' + '_ph0/' +prefix+'.phsave/control_ph.xml'
+    if not os.path.isfile(fname):
+        # Already moved by a previous run with --stage-mode move
+        fname = 'save/' + prefix+'.phsave/control_ph.xml'
 
-    fid = open(fname,'r')
-    lines = fid.readlines() # these files are relatively small so reading the whole thing shouldn't be an issue
-    fid.close()
-
-    line_number_of_nqpt = 0
-    while 'NUMBER_OF_Q_POINTS' not in lines[line_number_of_nqpt]: # increment to line of interest
-        line_number_of_nqpt +=1
-    line_number_of_nqpt +=1 # its on the next line after that text
-
-    nqpt = int(lines[line_number_of_nqpt])
+    # Read lines only up to the one of interest
+    with open(fname,'r') as fid:
+        for line in fid:
+            if 'NUMBER_OF_Q_POINTS' in line:
+                return int(next(fid)) # its on the next line after that text
 
-    return nqpt
+    raise ValueError(f'NUMBER_OF_Q_POINTS not found in {fname}')
 
 # Check if the calculation include SOC
 def hasSOC(prefix, outdir):
     fname = f'{outdir}/' + prefix+'.save/data-file-schema.xml'
 
-    xmldoc = minidom.parse(fname)
-    item = xmldoc.getElementsByTagName('spinorbit')[0]
-    lSOC = item.childNodes[0].data
+    # Stream the file and stop at the first spinorbit element, which is in the
+    # input section near the top, before the (large) band structure.
+    lSOC = None
+    for event, elem in ET.iterparse(fname, events=('end',)):
+        if elem.tag == 'spinorbit' or elem.tag.endswith('}spinorbit'):
+            lSOC = (elem.text or '').strip()
+            break
 
     if lSOC == 'true':
         return True
@@ -71,6 +95,12 @@ def hasXML(prefix, dyndir):
     if os.path.isfile(fname_no_xml):
         return False
 
+    # Already moved by a previous run with --stage-mode move
+    if os.path.isfile(os.path.join('save', prefix + ".dyn_q1.xml")):
+        return True
+    if os.path.isfile(os.path.join('save', prefix + ".dyn_q1")):
+        return False
+
     # Both prefix.dyn1.xml and prefix.dyn1 do not exsit.
     raise FileNotFoundError("No dyn1.xml or dyn1 file found.")
 
@@ -85,20 +115,348 @@ def isSEQ(prefix, outdir):
 
     return lseq
 
-# run cp command to copy file_from to file_to
-def do_copy(file_from, file_to, is_folder=False):
-    if is_folder:
-        os.system(f'cp -r {file_from} {file_to}')
+# Return the total size of a file or of all files in a folder
+def get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+# Stage modes, from the cheapest, and the modes tried in order for each of them.
+# A mode falls back to the next one when the filesystem does not support it
+# (e.g. hardlink across devices, or reflink outside of btrfs/XFS).
+STAGE_MODES = {
+    'copy': ('copy',),
+    'reflink': ('reflink', 'copy'),
+    'hardlink': ('hardlink', 'reflink', 'copy'),
+    'symlink': ('symlink', 'hardlink', 'reflink', 'copy'),
+    'move': ('move', 'reflink', 'copy'),
+}
+
+# ioctl request to clone a file on Linux (FICLONE in linux/fs.h)
+FICLONE = 0x40049409
+
+# Make dst a copy-on-write clone of src sharing the same data blocks
+def do_reflink(src, dst):
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copymode(src, dst)
+
+# Stage the file src to dst with the given mode, falling back to cheaper modes.
+# Return the mode that was used.
+def stage_file(src, dst, mode='copy'):
+    # Replace dst like cp does. Writing through an old symlink would overwrite its target.
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for imethod, method in enumerate(STAGE_MODES[mode]):
+        try:
+            if method == 'copy':
+                # On Linux, shutil uses sendfile, so the data is copied inside the kernel
+                shutil.copy(src, dst)
+            elif method == 'reflink':
+                do_reflink(src, dst)
+            elif method == 'hardlink':
+                os.link(src, dst)
+            elif method == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif method == 'move':
+                os.rename(src, dst)
+            break
+        except OSError:
+            if imethod == len(STAGE_MODES[mode]) - 1:
+                raise
+    if mode == 'move' and method != 'move':
+        os.remove(src)
+    return method
+
+# Return the blake2b checksum of a file
+def get_checksum(fname):
+    h = hashlib.blake2b(digest_size=16)
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(4 * 1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Record of the staged files, saved as a json file in save/.
+# For each destination, stores the source, the size and mtime of the source
+# and the destination, the stage mode and, if checksum is True, a checksum.
+class Manifest:
+    def __init__(self, fname, checksum=False):
+        self.fname = fname
+        self.checksum = checksum
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                self.entries = json.load(f)['files']
+
+    # Return True if dst was staged from src with mode and neither was changed since
+    def is_staged(self, src, dst, mode):
+        entry = self.entries.get(dst)
+        if entry is None or entry['mode'] != mode or not os.path.exists(dst):
+            return False
+        stat_dst = os.stat(dst)
+        if stat_dst.st_size != entry['size'] or stat_dst.st_mtime_ns != entry['dst_mtime_ns']:
+            return False
+        if src is None or not os.path.exists(src):
+            # Source was moved to dst
+            return mode == 'move'
+        stat_src = os.stat(src)
+        return stat_src.st_size == entry['size'] and stat_src.st_mtime_ns == entry['mtime_ns']
+
+    def add(self, src, dst, mode):
+        stat_dst = os.stat(dst)
+        # With move, src does not exist anymore, but dst has the same size and mtime
+        stat_src = os.stat(src) if os.path.exists(src) else stat_dst
+        entry = {
+            'source': src,
+            'size': stat_src.st_size,
+            'mtime_ns': stat_src.st_mtime_ns,
+            'dst_mtime_ns': stat_dst.st_mtime_ns,
+            'mode': mode,
+        }
+        if self.checksum:
+            entry['checksum'] = get_checksum(dst)
+        with self.lock:
+            self.entries[dst] = entry
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'files': self.entries}, indent=1)
+        with open(self.fname + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(self.fname + '.tmp', self.fname)
+
+    # Check dst against the manifest and its source. Return a list of problems.
+    def verify(self, dst):
+        entry = self.entries[dst]
+        src = entry['source']
+        if not os.path.exists(dst):
+            return ['missing']
+        problems = []
+        if os.path.getsize(dst) != entry['size']:
+            problems.append(f'size {os.path.getsize(dst)} != {entry["size"]} in manifest')
+        checksum = get_checksum(dst) if (self.checksum or 'checksum' in entry) else None
+        if 'checksum' in entry and checksum != entry['checksum']:
+            problems.append('checksum differs from manifest')
+        if os.path.exists(src):
+            if os.path.getsize(src) != os.path.getsize(dst):
+                problems.append(f'size differs from source {src}')
+            elif checksum is not None and not os.path.samefile(src, dst) and get_checksum(src) != checksum:
+                problems.append(f'checksum differs from source {src}')
+            elif checksum is None and os.stat(src).st_mtime_ns != entry['mtime_ns']:
+                problems.append(f'source {src} was modified after staging')
+        elif entry['mode'] != 'move':
+            problems.append(f'source {src} does not exist')
+        return problems
+
+# Check all files of the manifest in parallel, and list the files in savedir not in the manifest.
+# Return the number of problems found.
+def verify_manifest(manifest, savedir, jobs):
+    nproblems = 0
+    dsts = sorted(manifest.entries)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for dst, problems in zip(dsts, executor.map(manifest.verify, dsts)):
+            for problem in problems:
+                print(f'{dst}: {problem}')
+            nproblems += len(problems)
+    for root, dirs, files in os.walk(savedir):
+        for name in files:
+            fname = os.path.join(root, name)
+            if fname not in manifest.entries and fname != manifest.fname:
+                print(f'{fname}: not in manifest')
+                nproblems += 1
+    return nproblems
+
+# Stage file_from to file_to like cp (or cp -r if is_folder), using the given stage mode.
+# file_from may be a glob pattern that matches exactly one file.
+# Files already staged according to manifest are skipped, and staged files are added to it.
+# Return a dict with the number of bytes staged with each mode.
+def do_copy(file_from, file_to, is_folder=False, mode='copy', manifest=None):
+    if os.path.isdir(file_to):
+        file_to = os.path.join(file_to, os.path.basename(file_from.rstrip('/')))
+    nbytes = {}
+    def stage_and_count(src, dst):
+        if manifest is not None and manifest.is_staged(src, dst, mode):
+            nbytes['skipped'] = nbytes.get('skipped', 0) + os.path.getsize(dst)
+            return
+        size = os.path.getsize(src)
+        method = stage_file(src, dst, mode)
+        nbytes[method] = nbytes.get(method, 0) + size
+        if manifest is not None:
+            manifest.add(src, dst, mode)
+
+    matches = glob.glob(file_from)
+    if len(matches) != 1:
+        # Files moved to file_to in a previous run
+        if manifest is not None and len(matches) == 0 and mode == 'move':
+            staged = [dst for dst in manifest.entries if dst == file_to or dst.startswith(file_to + '/')]
+            if staged and all(manifest.is_staged(None, dst, mode) for dst in staged):
+                return {'skipped': sum(manifest.entries[dst]['size'] for dst in staged)}
+        raise FileNotFoundError(f'{file_from} matches {len(matches)} files instead of 1')
+    file_from = matches[0]
+
+    if not is_folder:
+        stage_and_count(file_from, file_to)
+    elif mode == 'move' and not os.path.exists(file_to):
+        size = get_size(file_from)
+        try:
+            os.rename(file_from, file_to)
+            nbytes['move'] = size
+            if manifest is not None:
+                for root, dirs, files in os.walk(file_to):
+                    for name in files:
+                        dst = os.path.join(root, name)
+                        manifest.add(os.path.join(file_from, os.path.relpath(dst, file_to)), dst, mode)
+        except OSError:
+            shutil.copytree(file_from, file_to, copy_function=stage_and_count)
+            shutil.rmtree(file_from)
     else:
-        os.system(f'cp {file_from} {file_to}')
+        shutil.copytree(file_from, file_to, copy_function=stage_and_count, dirs_exist_ok=True)
+        if mode == 'move':
+            shutil.rmtree(file_from)
+    return nbytes
+
+# Run do_copy for all (file_from, file_to, is_folder, mode) in transfers using jobs threads.
+# The manifest is saved after each transfer, so an interrupted run can be resumed.
+# Print the progress and the throughput, and exit if any copy fails.
+def do_copy_all(transfers, jobs, manifest=None):
+    time_start = time.time()
+    nbytes = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(do_copy, *transfer, manifest): transfer for transfer in transfers}
+        for itransfer, future in enumerate(as_completed(futures)):
+            file_from, file_to = futures[future][:2]
+            try:
+                nbytes_transfer = future.result()
+                for method, size in nbytes_transfer.items():
+                    nbytes[method] = nbytes.get(method, 0) + size
+                methods = ', '.join(nbytes_transfer)
+                print(f'[{itransfer+1}/{len(transfers)}] {file_from} -> {file_to} ({methods})')
+            except Exception as e:
+                failed.append((file_from, file_to, e))
+                print(f'[{itransfer+1}/{len(transfers)}] FAILED {file_from} -> {file_to}: {e}')
+            if manifest is not None:
+                manifest.save()
+    elapsed = time.time() - time_start
+    total = sum(size for method, size in nbytes.items() if method != 'skipped')
+    print(f'Staged {total / 1024**2:.1f} MB in {elapsed:.1f} s ({total / 1024**2 / max(elapsed, 1E-6):.1f} MB/s)')
+    for method, size in nbytes.items():
+        print(f'  {method:8s} {size / 1024**2:10.1f} MB')
+    if failed:
+        print(f'{len(failed)} of {len(transfers)} copies failed:')
+        for file_from, file_to, e in failed:
+            print(f'  {file_from} -> {file_to}: {e}')
+        sys.exit(1)
+
+# Return the total size of the files in a folder, without following symlinks
+def get_tree_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += get_tree_size(entry.path)
+        else:
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+# Scan the _ph* folders of outdir once and return the cleanup plan:
+# wfc_files: list of (path, size) of the temporary wavefunction files in _ph*/prefix.q_*/
+# merges: list of (folder_from, folder_to) moving _ph[1-9]*/prefix.q_* of image parallelization to _ph0
+# image_dirs: the _ph[1-9]* folders, removed after the merge
+def plan_cleanup(prefix, outdir):
+    wfc_files = []
+    merges = []
+    image_dirs = []
+    with os.scandir(outdir) as it:
+        ph_dirs = sorted((entry for entry in it if entry.name.startswith('_ph') and entry.is_dir()), key=lambda e: e.name)
+    for ph_dir in ph_dirs:
+        is_image = len(ph_dir.name) > 3 and ph_dir.name[3] in '123456789'
+        if is_image:
+            image_dirs.append(ph_dir.path)
+        with os.scandir(ph_dir.path) as it:
+            q_dirs = sorted((entry for entry in it if entry.name.startswith(prefix + '.q_') and entry.is_dir()), key=lambda e: e.name)
+        for q_dir in q_dirs:
+            with os.scandir(q_dir.path) as it:
+                for entry in it:
+                    if 'wfc' in entry.name and not entry.is_dir(follow_symlinks=False):
+                        wfc_files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+            if is_image:
+                merges.append((q_dir.path, os.path.join(outdir, '_ph0', q_dir.name)))
+    return wfc_files, merges, image_dirs
+
+# Move folder_from to folder_to like mv. If folder_to exists, merge the contents.
+def merge_folder(folder_from, folder_to):
+    if not os.path.exists(folder_to):
+        os.rename(folder_from, folder_to)
+        return
+    for entry in os.scandir(folder_from):
+        target = os.path.join(folder_to, entry.name)
+        if entry.is_dir(follow_symlinks=False) and os.path.isdir(target):
+            merge_folder(entry.path, target)
+        else:
+            os.replace(entry.path, target)
+    os.rmdir(folder_from)
+
+# Delete the wfc files using jobs threads, merge the image folders to _ph0 and remove them.
+# With dry_run, only print what would be done.
+def do_cleanup(wfc_files, merges, image_dirs, jobs, dry_run=False):
+    wfc_size = sum(size for fname, size in wfc_files)
+    if dry_run:
+        for fname, size in wfc_files:
+            print(f'Would remove {fname} ({size / 1024**2:.1f} MB)')
+        for folder_from, folder_to in merges:
+            print(f'Would move {folder_from} -> {folder_to}')
+        for folder in image_dirs:
+            print(f'Would remove {folder}')
+        print(f'Would remove {len(wfc_files)} wfc files ({wfc_size / 1024**2:.1f} MB) and {len(image_dirs)} image folders')
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(os.remove, (fname for fname, size in wfc_files)))
+    for folder_from, folder_to in merges:
+        merge_folder(folder_from, folder_to)
+    image_size = 0
+    for folder in image_dirs:
+        image_size += get_tree_size(folder)
+        shutil.rmtree(folder)
+    print(f'Removed {len(wfc_files)} wfc files ({wfc_size / 1024**2:.1f} MB)')
+    if image_dirs:
+        print(f'Merged {len(merges)} folders to _ph0 and removed {len(image_dirs)} image folders ({image_size / 1024**2:.1f} MB)')
+    print(f'Reclaimed {(wfc_size + image_size) / 1024**2:.1f} MB')
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description='Post-processing script for PH data in format used by EPW')
 parser.add_argument('prefix', nargs='?', help='Prefix used for PH calculations (e.g. diam)')
 parser.add_argument('--outdir', default='temp', help='Output directory (default: temp)')
 parser.add_argument('--dyndir', default='dyn_dir', help='Dynamical matrix directory (default: dyn_dir)')
+parser.add_argument('--jobs', type=int, default=4, help='Number of files copied concurrently (default: 4)')
+parser.add_argument('--stage-mode', choices=STAGE_MODES, default='copy',
+                    help='How files are put in save/. Falls back to cheaper modes when not supported (default: copy)')
+parser.add_argument('--checksum', action='store_true', help='Store checksums of the staged files in the manifest and compare them in --verify')
+parser.add_argument('--verify', action='store_true', help='Only check the files in save/ against the manifest and the sources')
+parser.add_argument('--dry-run', action='store_true', help='Only print the files that would be removed, merged and staged')
 args = parser.parse_args()
 
+manifest = Manifest('save/.epw_pp_manifest.json', checksum=args.checksum)
+
+if args.verify:
+    if not manifest.entries:
+        sys.exit('No manifest found in save/')
+    nproblems = verify_manifest(manifest, 'save', args.jobs)
+    if nproblems > 0:
+        sys.exit(f'{nproblems} problems found')
+    print(f'All {len(manifest.entries)} staged files verified')
+    sys.exit(0)
+
 if args.prefix:
     prefix = args.prefix.strip()
 else:
@@ -120,34 +478,33 @@ SEQ = isSEQ(prefix, outdir)
 # gets nqpt from the output files
 nqpt = get_nqpt(prefix, outdir)
 
-# Delete temporary wavefunction file
-os.system(f'rm -f {outdir}/_ph*/{prefix}.q_*/*wfc*')
+# Delete temporary wavefunction files.
+# For image parallization, move all output data to _ph0 and remove image parallelized output folders.
+wfc_files, merges, image_dirs = plan_cleanup(prefix, outdir)
+do_cleanup(wfc_files, merges, image_dirs, args.jobs, dry_run=args.dry_run)
 
-# For image parallization
-if os.path.isdir(f'{outdir}/_ph1'):
-    # Move all output data to _ph0
-    os.system(f'mv {outdir}/_ph[1-9]*/{prefix}.q_*/ {outdir}/_ph0/')
-    # Remove image parallelized output folders
-    os.system(f'rm -rf {outdir}/_ph[1-9]*/')
+stage_mode = args.stage_mode
 
-os.system('mkdir -p save')
+# List of (file_from, file_to, is_folder, mode) to copy
+transfers = []
 
 # Copy dynamical matrix and force constant files
 if XML:
-    do_copy(f'{dyndir}/{prefix}.dyn0', f'{dyndir}/{prefix}.dyn0.xml')
-    do_copy(f'{prefix}.fc.xml', 'save/ifc.q2r.xml')
+    # dyn0 is also kept in dyndir, so it is always copied
+    transfers.append((f'{dyndir}/{prefix}.dyn0', f'{dyndir}/{prefix}.dyn0.xml', False, 'copy'))
+    transfers.append((f'{prefix}.fc.xml', 'save/ifc.q2r.xml', False, stage_mode))
 else:
-    do_copy(f'{prefix}.fc', 'save/ifc.q2r')
+    transfers.append((f'{prefix}.fc', 'save/ifc.q2r', False, stage_mode))
 
 for iqpt in range(1, nqpt+1):
     label = str(iqpt)
     if XML:
-        do_copy(f'{dyndir}/{prefix}.dyn{iqpt}.xml', f'save/{prefix}.dyn_q{label}.xml')
+        transfers.append((f'{dyndir}/{prefix}.dyn{iqpt}.xml', f'save/{prefix}.dyn_q{label}.xml', False, stage_mode))
     else:
-        do_copy(f'{dyndir}/{prefix}.dyn{iqpt}', f'save/{prefix}.dyn_q{label}')
+        transfers.append((f'{dyndir}/{prefix}.dyn{iqpt}', f'save/{prefix}.dyn_q{label}', False, stage_mode))
 
 # Copy phsave folder
-do_copy(f'{outdir}/_ph0/{prefix}.phsave', 'save/', is_folder=True)
+transfers.append((f'{outdir}/_ph0/{prefix}.phsave', 'save/', True, stage_mode))
 
 # Copy dvscf files
 if not SEQ:
@@ -167,8 +524,14 @@ for iqpt in range(1, nqpt+1):
     else:
         dvscf_from = f'{outdir}/_ph0/{prefix}.q_{iqpt}/{prefix}.dvscf' + postfix
 
-    do_copy(dvscf_from, dvscf_to)
+    transfers.append((dvscf_from, dvscf_to, False, stage_mode))
+
+if args.dry_run:
+    for file_from, file_to, is_folder, mode in transfers:
+        print(f'Would stage {file_from} -> {file_to} ({mode})')
+    sys.exit(0)
+
+os.makedirs('save', exist_ok=True)
 
-    # Delete temporary wavefunction file
-    os.system(f'rm -f {outdir}/_ph0/{prefix}.q_{iqpt}/*wfc*')
+do_copy_all(transfers, args.jobs, manifest)
 
@@ -0,0 +1,12 @@
+"""
+Stamp of a source file, stored in the caches of these scripts. A cache is
+valid as long as the stamp of its source is unchanged. The size and the
+mtime in nanoseconds are compared exactly, so a file replaced by one with an
+older or equal mtime (cp -p, rsync, coarse timestamps) is detected.
+"""
+import os
+
+def source_stamp(filename):
+    """Return the stamp of filename: a JSON-serializable dict with its path, size and mtime_ns."""
+    st = os.stat(filename)
+    return {'path': os.path.abspath(filename), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
@@ -1,6 +1,29 @@
 #!/usr/bin/env python3
+"""
+Format BibTeX files: abbreviate journal names, protect the capitalization of
+some words in titles, use hyphens in page ranges, fix indentation and remove
+notes. The result for file.bib is written to file.bib.new.
+
+Usage: format_bibtex.py file.bib [file2.bib or directory ...] [-j JOBS] [--incremental]
+                        [--journal-table journals.csv ...]
+
+With --incremental, formatted entries are cached in .file.bib.cache.json and
+only new or edited entries are formatted again.
+
+Journal names are matched ignoring case, punctuation and a leading "The".
+--journal-table adds external tables of "full name,abbreviation" rows, which
+are indexed once in .journals.csv.index.json next to the table.
+"""
+import os
 import sys
 import re
+import csv
+import json
+import hashlib
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from filestamp import source_stamp
 
 _INDENT = "    "
 _journal_abbr_dict = {
@@ -63,10 +86,6 @@ _journal_abbr_dict = {
     "Canadian Journal of Physics" : "Can. J. Phys.",
     "The London, Edinburgh, and Dublin Philosophical Magazine and Journal of Science" : "Philos. Mag.",
 }
-values = list(_journal_abbr_dict.values())
-for value in values:
-    _journal_abbr_dict[value] = value
-
 
 _words_to_capitalize = [
     "Hall", "ZnO", "Be(0001)", "Mo(110)", "${\\mathrm{TiO}}_{2}$", "Green's",
@@ -80,96 +99,395 @@ _words_to_convert = {
     "GW" : "$GW$"
 }
 
+# Characters other than letters, digits and spaces, ignored in journal names
+_JOURNAL_PUNCTUATION = re.compile(r"[^\w\s]+")
+# Version of normalize_journal stored in the index files. Increase when it changes.
+_NORMALIZE_VERSION = 1
+
+def normalize_journal(name):
+    """
+    Return the key of a journal name in the journal indices: case folded,
+    "&" read as "and", punctuation and braces removed, whitespace collapsed and
+    a leading "The" dropped. "The Physical review B." -> "physical review b".
+    """
+    name = name.replace("{", "").replace("}", "").replace("&", " and ")
+    name = _JOURNAL_PUNCTUATION.sub(" ", name.casefold())
+    words = name.split()
+    if words[:1] == ["the"]:
+        words = words[1:]
+    return " ".join(words)
+
+def _build_journal_index(table):
+    """Index (full name, abbreviation) pairs by normalized name. Abbreviations map to themselves."""
+    index = {}
+    for name, abbr in table:
+        index.setdefault(normalize_journal(name), abbr)
+    for name, abbr in table:
+        index.setdefault(normalize_journal(abbr), abbr)
+    return index
+
+@functools.lru_cache(maxsize=None)
+def _builtin_journal_index():
+    return _build_journal_index(_journal_abbr_dict.items())
+
+def _read_journal_table(filename):
+    """
+    Read (full name, abbreviation) pairs from a CSV or TSV file, one journal
+    per row, e.g. as distributed by JabRef. The delimiter is a tab, ";" or ","
+    as found in the first row. Other columns and lines starting with # are ignored.
+    """
+    with open(filename, "r", newline="") as f:
+        first = next((line for line in f if not line.startswith("#")), "")
+        f.seek(0)
+        delimiter = "\t" if "\t" in first else ";" if ";" in first else ","
+        for row in csv.reader(f, delimiter=delimiter):
+            if len(row) < 2 or row[0].startswith("#"):
+                continue
+            yield row[0].strip(), row[1].strip()
+
+@functools.lru_cache(maxsize=None)
+def load_journal_table(filename):
+    """
+    Return the normalized index of an external journal table. The index is
+    built once and saved next to the table as .name.index.json, which is used
+    as long as the table does not change.
+    """
+    dirname, basename = os.path.split(filename)
+    index_file = os.path.join(dirname, "." + basename + ".index.json")
+    stamp = source_stamp(filename)
+    try:
+        with open(index_file, "r") as f:
+            data = json.load(f)
+        if data["source"] == stamp and data["normalize"] == _NORMALIZE_VERSION:
+            return data["journals"]
+    except (OSError, ValueError, KeyError):
+        pass
+    index = _build_journal_index(list(_read_journal_table(filename)))
+    try:
+        with open(index_file + ".tmp", "w") as f:
+            json.dump({"source": stamp, "normalize": _NORMALIZE_VERSION, "journals": index}, f)
+        os.replace(index_file + ".tmp", index_file)
+    except OSError:
+        pass # Index is optional, e.g. in a read-only directory
+    return index
+
+def abbreviate_journal(name, journal_tables=()):
+    """
+    Return the abbreviation of a journal name, or None if unknown. Exact names
+    of _journal_abbr_dict are looked up first, then the normalized name in the
+    built-in table and in the external tables in journal_tables, in order.
+    """
+    if name in _journal_abbr_dict:
+        return _journal_abbr_dict[name]
+    key = normalize_journal(name)
+    for index in [_builtin_journal_index()] + [load_journal_table(table) for table in journal_tables]:
+        if key in index:
+            return index[key]
+    return None
+
+@functools.lru_cache(maxsize=None)
+def _compile_title_words(words_to_capitalize, words_to_convert):
+    """
+    Compile the word tables into one regex matching " word" followed by " ",
+    ", " or the end of the title, and a dict of the replacement of each word.
+    A word listed twice keeps its first replacement, as in sequential replaces.
+    """
+    replacements = {}
+    for word in words_to_capitalize:
+        replacements.setdefault(word, "{" + word + "}")
+    for word, word_new in words_to_convert:
+        replacements.setdefault(word, "{" + word_new + "}")
+    pattern = re.compile(" (" + "|".join(re.escape(word) for word in replacements) + r")(?= |, |\Z)")
+    return pattern, replacements
+
+def format_title(title):
+    """
+    Protect the capitalization of the words in _words_to_capitalize and convert
+    the words in _words_to_convert, in a single pass over the title.
+    Gives the same result as replacing " word ", " word, " and a trailing
+    " word" for each word in turn.
+    """
+    pattern, replacements = _compile_title_words(tuple(_words_to_capitalize), tuple(_words_to_convert.items()))
+    # str.replace consumes the delimiter after a match, so the same word right
+    # after it with the same delimiter is not replaced: " Si Si " -> " {Si} Si "
+    last = {"word": None, "delim": None, "end": -1}
+    def replace(match):
+        word = match.group(1)
+        delim = title[match.end():match.end() + 2]
+        delim = delim if delim == ", " else delim[:1]
+        if word == last["word"] and delim == last["delim"] and match.start() < last["end"]:
+            last["word"] = None
+            return match.group(0)
+        last.update(word=word, delim=delim, end=match.end() + len(delim))
+        return " " + replacements[word]
+    return pattern.sub(replace, title)
+
+@functools.lru_cache(maxsize=None)
+def _compile_field(keyword):
+    """Regex matching the field keyword and capturing its value: {value}, "value" or value."""
+    return re.compile(keyword + r'\s*=\s*(?:"?\{(.*)\}"?|"(.*)"|([^\s{"].*?|))\s*,?\s*$', re.IGNORECASE | re.DOTALL)
+
 def extract_content(text, keyword):
-    match = re.search(keyword + r'\s*=\s*"?\{(.+)\}"?', text, re.IGNORECASE)
+    match = _compile_field(keyword).match(text.strip())
     if match:
-        return match.group(1)
-    match = re.search(keyword + r'\s*=\s*"?\{?(.*?)}?"?', text, re.IGNORECASE)
-    if match:
-        return match.group(1)
+        return next(value for value in match.groups() if value is not None)
     return None
 
-filename = sys.argv[1]
+# Braces and quotes that change the nesting level, skipping escaped characters
+_BRACE_TOKENS = re.compile(r'\\.|[{}"]')
 
-filename_write = filename + ".new"
+def _scan_braces(line, depth, in_quote):
+    """Return the brace depth and whether a quoted value is open after line."""
+    if '"' not in line and "\\" not in line:
+        return depth + line.count("{") - line.count("}"), in_quote
+    for match in _BRACE_TOKENS.finditer(line):
+        c = match.group(0)
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+        elif c == '"' and depth == 1:
+            in_quote = not in_quote
+    return depth, in_quote
 
-fr = open(filename, "r")
-fw = open(filename_write, "w")
+def iter_entries(lines):
+    """
+    Group lines of a BibTeX file into entries, reading one line at a time.
+    Yield each entry, from its @ line to the line closing its braces, as a list
+    of fields. Each field is the list of lines it spans, so values with nested
+    braces or quotes can continue over several lines. Lines outside entries are
+    yielded as an entry of one single-line field.
+    """
+    entry = []
+    field = []
+    depth = 0
+    in_quote = False
+    for line in lines:
+        is_start = line.lstrip().startswith("@")
+        if (entry or field) and is_start:
+            # The previous entry was not closed
+            if field:
+                entry.append(field)
+                field = []
+            yield entry
+            entry = []
+            depth = 0
+            in_quote = False
+        if not entry and not field and not is_start:
+            yield [[line]]
+            continue
+        field.append(line)
+        depth, in_quote = _scan_braces(line, depth, in_quote)
+        if depth <= 1 and not in_quote:
+            entry.append(field)
+            field = []
+            if depth <= 0:
+                yield entry
+                entry = []
+                depth = 0
+    if field:
+        entry.append(field)
+    if entry:
+        yield entry
 
-for line in fr:
-    # Skip empty line
-    if len(line.strip()) == 0:
-        fw.write(line)
-        continue
+def format_line(line):
+    """Fix indentation to four spaces."""
+    if len(line.strip()) > 0 and line.strip()[0].isalpha():
+        return _INDENT + line.strip() + "\n"
+    return line
 
-    line_new = line
-
-    # Fix indentation to four spaces
-    if line_new.strip()[0].isalpha():
-        line_new = _INDENT + line.strip() + "\n"
+def format_field(lines, warnings, journal_tables=()):
+    """
+    Format one field given as the list of lines it spans. Journal, title and
+    pages are rewritten on a single line, note is removed, and the other lines
+    are only reindented. Warnings are appended to warnings. journal_tables are
+    external journal tables used after _journal_abbr_dict.
+    """
+    # Skip empty line
+    if len(lines[0].strip()) == 0:
+        return "".join(lines)
 
-    data = line.strip().split()
-    keyword = data[0].lower()
+    keyword = lines[0].split(None, 1)[0].lower()
     keyword = keyword.split("=")[0].lower()
+    if keyword not in ("journal", "title", "pages", "note"):
+        return "".join(format_line(line) for line in lines)
+
+    # Value of a field spanning several lines, on one line
+    text = " ".join(line.strip() for line in lines)
 
     if keyword == "journal":
         # Journal abbreviation
-        if "{" in line:
-            journal_name = re.search(r"\{(.+?)\}", line).group(1)
-        elif '"' in line:
-            journal_name = re.search(r'"(.+?)"', line).group(1)
-
-        if journal_name in _journal_abbr_dict:
-            journal_name_new = _journal_abbr_dict[journal_name]
-        elif "arxiv" in journal_name.lower():
-            journal_name_new = journal_name
+        if "{" in text:
+            journal_name = re.search(r"\{(.+?)\}", text).group(1)
+        elif '"' in text:
+            journal_name = re.search(r'"(.+?)"', text).group(1)
         else:
-            print(f"Unknown journal {journal_name}")
+            # String macro
+            return "".join(format_line(line) for line in lines)
+
+        journal_name_new = abbreviate_journal(journal_name, journal_tables)
+        if journal_name_new is None:
+            if "arxiv" not in journal_name.lower():
+                warnings.append(f"Unknown journal {journal_name}")
             journal_name_new = journal_name
 
-        line_new = _INDENT + "journal = {" + journal_name_new + "},\n"
+        return _INDENT + "journal = {" + journal_name_new + "},\n"
 
     elif keyword == "title":
         # Capitalization and math formatting of title
-        title = extract_content(line, keyword)
+        title = extract_content(text, keyword)
         if title is None:
-            print("WARNING : Title parsing failed")
-            print(line)
+            warnings.append("WARNING : Title parsing failed\n" + text)
+            return "".join(format_line(line) for line in lines)
 
-        for word in _words_to_capitalize:
-            title = title.replace(" " + word + " ", " {" + word + "} ")
-            title = title.replace(" " + word + ", ", " {" + word + "}, ")
-            if title.endswith(" " + word):
-                n = len(word) + 1
-                title = title[:-n] + " {" + word + "}"
+        title = format_title(title)
 
-        for word, word_new in _words_to_convert.items():
-            title = title.replace(" " + word + " ", " {" + word_new + "} ")
-            title = title.replace(" " + word + ", ", " {" + word_new + "}, ")
-            if title.endswith(" " + word):
-                n = len(word) + 1
-                title = title[:-n] + " {" + word_new + "}"
-
-        line_new = _INDENT + "title = {" + title + "},\n"
+        return _INDENT + "title = {" + title + "},\n"
 
     elif keyword == "pages":
         # Replace EN DASH by hyphen
-        pages = extract_content(line, keyword)
+        pages = extract_content(text, keyword)
         if pages is None:
-            print("WARNING : pages parsing failed")
-            print(line)
+            warnings.append("WARNING : pages parsing failed\n" + text)
+            return "".join(format_line(line) for line in lines)
 
         pages = pages.replace("–", "-")
         pages = pages.replace("--", "-")
-        line_new = _INDENT + "pages = {" + pages + "},\n"
+        return _INDENT + "pages = {" + pages + "},\n"
 
     elif keyword == "note":
-        line_new = ""
-    else:
-        pass
+        return ""
+
+# Citation key in the first line of an entry
+_CITATION_KEY = re.compile(r'\s*@\s*\w+\s*[{(]\s*([^,\s]+)\s*,')
+
+@functools.lru_cache(maxsize=None)
+def _tables_hash(journal_tables=()):
+    """
+    Hash of the tables, the external journal tables and this script. Cached
+    entries formatted with different tables or code are not used.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    tables = [_INDENT, _journal_abbr_dict, _words_to_capitalize, _words_to_convert]
+    tables += [source_stamp(table) for table in journal_tables]
+    h.update(json.dumps(tables, sort_keys=True).encode())
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def get_cache_file(filename):
+    """Return the cache file of --incremental for filename: .name.bib.cache.json in the same directory."""
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, "." + basename + ".cache.json")
+
+def load_entry_cache(cache_file, journal_tables=()):
+    """Return the cached formatted entries of cache_file, or {} if missing, unreadable or outdated."""
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("tables") != _tables_hash(journal_tables):
+        return {}
+    return cache["entries"]
+
+def save_entry_cache(cache_file, entries, journal_tables=()):
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump({"tables": _tables_hash(journal_tables), "entries": entries}, f)
+    os.replace(cache_file + ".tmp", cache_file)
+
+def format_file(filename, incremental=False, journal_tables=()):
+    """
+    Format filename entry by entry and write the result to filename.new,
+    replacing it atomically. Return (filename_write, warnings, ncached).
+
+    If incremental is True, each entry is cached by its citation key and the
+    hash of its text, and unchanged entries are copied from the cache of the
+    previous run. ncached is the number of entries taken from the cache.
+    journal_tables are external journal tables, see load_journal_table.
+    """
+    filename_write = filename + ".new"
+    warnings = []
+    cache_file = get_cache_file(filename)
+    cache = load_entry_cache(cache_file, journal_tables) if incremental else {}
+    cache_new = {}
+    ncached = 0
+    try:
+        with open(filename, "r") as fr, open(filename_write + ".tmp", "w") as fw:
+            for entry in iter_entries(fr):
+                key = None
+                if incremental:
+                    match = _CITATION_KEY.match(entry[0][0])
+                    if match:
+                        raw = "".join(line for field in entry for line in field)
+                        key = match.group(1) + " " + hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+                if key in cache:
+                    text, entry_warnings = cache[key]
+                    ncached += 1
+                else:
+                    entry_warnings = []
+                    text = "".join(format_field(field, entry_warnings, journal_tables) for field in entry)
+                if key is not None:
+                    cache_new[key] = (text, entry_warnings)
+                warnings += entry_warnings
+                fw.write(text)
+        os.replace(filename_write + ".tmp", filename_write)
+    except BaseException:
+        if os.path.exists(filename_write + ".tmp"):
+            os.remove(filename_write + ".tmp")
+        raise
+    if incremental:
+        try:
+            save_entry_cache(cache_file, cache_new, journal_tables)
+        except OSError as e:
+            warnings.append(f"WARNING : cannot write cache {cache_file}: {e}")
+    return filename_write, warnings, ncached
+
+def find_bib_files(paths):
+    """Return the files in paths, with directories replaced by the .bib files in them."""
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                filenames += [os.path.join(root, name) for name in sorted(files) if name.endswith(".bib")]
+        else:
+            filenames.append(path)
+    return filenames
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Format BibTeX files. The result for file.bib is written to file.bib.new.")
+    parser.add_argument("paths", nargs="+", help=".bib files, or directories searched for .bib files")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of files formatted in parallel (default: number of cores)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Cache formatted entries next to each file and only format new or edited entries")
+    parser.add_argument("--journal-table", action="append", default=[],
+                        help="CSV or TSV file of full journal names and abbreviations, used after the built-in table. Can be repeated.")
+    args = parser.parse_args()
+    journal_tables = tuple(args.journal_table)
 
+    # Build the indices once here, so that the worker processes only read them
+    for table in journal_tables:
+        load_journal_table(table)
 
-    fw.write(line_new)
+    filenames = find_bib_files(args.paths)
+    if len(filenames) == 0:
+        parser.error("No .bib files found")
 
-fr.close()
-fw.close()
\ No newline at end of file
+    nfailed = 0
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(filenames))) as executor:
+        futures = [executor.submit(format_file, filename, args.incremental, journal_tables) for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            prefix = f"{filename}: " if len(filenames) > 1 else ""
+            try:
+                filename_write, warnings, ncached = future.result()
+            except Exception as e:
+                print(f"{prefix}ERROR : {type(e).__name__}: {e}")
+                nfailed += 1
+                continue
+            for warning in warnings:
+                print(prefix + warning)
+            if args.incremental:
+                print(f"{prefix}{ncached} entries unchanged, taken from the cache")
+    if nfailed > 0:
+        sys.exit(f"{nfailed} of {len(filenames)} files failed")
@@ -6,22 +6,51 @@ by parsing the seedname.xml file in the outdir.
 k-point path, and
 2) writes a "seedname.bands.dat.gnu" file that contains band structure
 information directly plottable by gnuplot.
+3) with --npz, writes the same data to "seedname.bands.dat.gnu.npz", which
+plotband.py reads without text parsing.
 
-Usage: python3 ~/bin/my_qe_bands.py seedname outdir > seedname.plotband.out
+Usage: python3 ~/bin/my_qe_bands.py seedname outdir [--npz] > seedname.plotband.out
 """
 from __future__ import absolute_import, division, print_function
 import os
 import sys
+import json
 import xml.etree.ElementTree as ET
 import numpy as np
+from qe_parse_energy import text_to_array, load_cache, save_cache
+from filestamp import source_stamp
 
-hartree_to_ev = lambda x: float(x) * 27.21138602
+HARTREE_TO_EV = 27.21138602
+hartree_to_ev = lambda x: float(x) * HARTREE_TO_EV
 bohr_to_ang = lambda x: float(x) * 0.529177249
 
-def parse_bandsdata(xml_file):
-    from copy import copy
+_BANDSDATA_ARRAYS = ('band_energies', 'occupations', 'kpoints_cart')
 
+def parse_bandsdata(xml_file, cache=False):
+    """
+    Parse band structure data from the xml file. If cache is True, the result
+    is stored in the sidecar cache of qe_parse_energy and later calls return
+    memory-mapped arrays until the xml file changes.
+    """
     print("Reading {}".format(xml_file))
+    if cache:
+        cached = load_cache(xml_file, 'bandsdata')
+        if cached is not None:
+            meta, arrays = cached
+            return dict(meta, **arrays)
+
+    bandsdata = _parse_bandsdata(xml_file)
+
+    if cache:
+        meta = {k: v for k, v in bandsdata.items() if k not in _BANDSDATA_ARRAYS}
+        arrays = {k: bandsdata[k] for k in _BANDSDATA_ARRAYS}
+        try:
+            save_cache(xml_file, 'bandsdata', meta, arrays)
+        except OSError as e:
+            sys.stderr.write("Warning: cannot write parse cache for {}: {}\n".format(xml_file, e))
+    return bandsdata
+
+def _parse_bandsdata(xml_file):
     bandsdata = {}
 
     # parse xml file
@@ -58,9 +87,10 @@ def parse_bandsdata(xml_file):
     occupations = np.zeros((nks, nbnd))
     iks = 0
     for node_ks in node_band.findall('ks_energies'):
-        band_energies[iks,:] = [hartree_to_ev(x) for x in node_ks.find('eigenvalues').text.split()]
-        occupations[iks,:] = [float(x) for x in node_ks.find('occupations').text.split()]
+        band_energies[iks,:] = text_to_array(node_ks.find('eigenvalues').text)
+        occupations[iks,:] = text_to_array(node_ks.find('occupations').text)
         iks += 1
+    band_energies *= HARTREE_TO_EV
     bandsdata['band_energies'] = band_energies.copy()
     bandsdata['occupations'] = occupations.copy()
 
@@ -68,111 +98,115 @@ def parse_bandsdata(xml_file):
     node_kpoint = root.find('.//starting_k_points')
     iks = 0
     for node_ks in node_kpoint.findall('k_point'):
-        kpoints_cart[:,iks] = [float(x) for x in node_ks.text.split()]
+        kpoints_cart[:,iks] = text_to_array(node_ks.text)
         iks += 1
     bandsdata['kpoints_cart'] = kpoints_cart.copy()
     return bandsdata
 
-def punch_plottable_bands(bandsdata, gnu_file):
+def segment_kpath(kpts):
+    """
+    Find the high-symmetry points and the plot x coordinates of a k-point path,
+    as done by bands.x. kpts has shape (3, nks).
+
+    A point is a high-symmetry point if it is an end point, if the path has a
+    kink there, or if it is Gamma. The x coordinate grows by |dk| along the
+    path, except at jumps (|dk| > 5 times the last regular |dk|), where two
+    distant points are put on the same x.
+
+    Returns (high_sym_idx, kx_plot, segments): the indices of the high-symmetry
+    points, the x coordinates of all points, and an (nlines, 2) array with the
+    first and last index of each line between two high-symmetry points.
+    """
+    nks = kpts.shape[1]
+    dk = np.diff(kpts, axis=1)
+    dxmod = np.zeros(nks)
+    dxmod[1:] = np.linalg.norm(dk, axis=0)
+
+    # Kinks: the direction changes between k(ik-1) -> k(ik) and k(ik) -> k(ik+1)
+    high_symmetry = np.ones(nks, dtype=bool)
+    if nks > 2:
+        n1 = dxmod[1:-1]
+        n2 = dxmod[2:]
+        if np.any(n1 < 1.E-4) or np.any(n2 < 1.E-4):
+            sys.stdout.write('punch_plottable_bands: two consecutive same k, exiting\n')
+            raise ValueError()
+        ps = np.einsum('ij,ij->j', dk[:, :-1], dk[:, 1:]) / (n1 * n2)
+        high_symmetry[1:-1] = np.abs(ps - 1.0) > 1.E-4
+        # The gamma point is a high symmetry point
+        high_symmetry[1:-1] |= np.linalg.norm(kpts[:, 1:-1], axis=0) < 1.E-4
+
+    # A step is a jump if dxmod > 5 * dxmod_save, where dxmod_save is dxmod of
+    # the last regular (not a jump, not zero) step, starting from dxmod[1].
+    # Jumps depend on the previous ones, so this is one sequential pass.
+    jump = np.zeros(nks, dtype=bool)
+    dx = dxmod.tolist()
+    dxmod_save = dx[1] if nks > 1 else 0.0
+    for ik in range(1, nks):
+        if dx[ik] > 5 * dxmod_save:
+            jump[ik] = True
+        elif dx[ik] > 1.E-4:
+            dxmod_save = dx[ik]
+
+    # Jumps put two distant points on the same x
+    kx_plot = np.cumsum(np.where(jump, 0.0, dxmod))
+
+    high_sym_idx = np.nonzero(high_symmetry)[0]
+    segments = np.column_stack((high_sym_idx[:-1], high_sym_idx[1:]))
+    return high_sym_idx, kx_plot, segments
+
+def punch_plottable_bands(bandsdata, gnu_file, binary_file=None):
     """
     Ported from the fortran subroutine punch_plottable_bands in bands.f90 of
     Quantum ESPRESSO v6.4
+    If binary_file is given, also write the x coordinates and the band energies
+    (shape (nbnd, nks)) to it in the .npz format.
     """
-    MAX_LINES = 100
-
     nks = bandsdata['nks']
     nbnd = bandsdata['nbnd']
     kpts = bandsdata['kpoints_cart']
-    high_symmetry = [False] * nks
-    for ik in range(nks):
-        if ik==0 or ik==nks-1:
-            high_symmetry[ik] = True
-        else:
-            k1 = kpts[:,ik] - kpts[:,ik-1]
-            k2 = kpts[:,ik+1] - kpts[:,ik]
-            if np.linalg.norm(k1) < 1.E-4 or np.linalg.norm(k2) < 1.E-4:
-                sys.stdout.write('punch_plottable_bands: two consecutive same k, exiting\n')
-                raise ValueError()
-            ps = np.dot(k1, k2) / (np.linalg.norm(k1) * np.linalg.norm(k2))
-            high_symmetry[ik] = abs(ps-1.0) > 1.E-4 # If kink, then high symmetry
-
-            # The gamma point is a high symmetry point
-            if np.linalg.norm(kpts[:,ik]) < 1.E-4:
-                high_symmetry[ik] = True
-
-            # save the typical length of dk
-            if ik == 1:
-                dxmod_save = np.linalg.norm(k1)
-
-    kx_plot = np.zeros(nks)
-    for ik in range(1, nks):
-        dxmod = np.linalg.norm(kpts[:,ik] - kpts[:,ik-1])
-        if dxmod > 5*dxmod_save:
-            # A big jump in dxmod is a sign that the point xk(:,n) and xk(:,n-1)
-            # are quite distant and belong to two different lines. We put them on
-            # the same point in the graph
-            kx_plot[ik] = kx_plot[ik-1]
-        elif dxmod > 1.E-4:
-            # This is the usual case. The two points xk(:,n) and xk(:,n-1) are in
-            # the same path.
-            kx_plot[ik] = kx_plot[ik-1] + dxmod
-            dxmod_save = dxmod
-        else:
-            # This is the case in which dxmod is almost zero. The two points
-            # coincide in the graph, but we do not save dxmod.
-            kx_plot[ik] = kx_plot[ik-1] + dxmod
-
-    # Now we compute how many paths there are: nlines
-    # The first point of this path: point(iline)
-    # How many points are in each path: npoints(iline)
-    npoints = np.zeros(nks)
-    point = np.zeros(nks)
-    for ik in range(nks):
-        if high_symmetry[ik]:
-            if ik == 0:
-                # first point. Initialize the number of lines, and the number of point
-                # and say that this line start at the first point
-                nlines = 1
-                npoints[0] = 1
-                point[0] = 1
-            elif ik == nks-1:
-                # Last point. Here we save the last point of this line, but
-                # do not increase the number of lines
-                npoints[nlines-1] = npoints[nlines-1] + 1
-                point[nlines] = ik + 1
-            else:
-                # Middle line. The current line has one more points, and there is
-                # a new line that has to be initialized. It has one point and its
-                # first point is the current k.
-                npoints[nlines-1] = npoints[nlines-1] + 1
-                nlines = nlines + 1
-                if nlines > MAX_LINES:
-                    sys.stdout.write('punch_plottable_bands: too many lines, exiting\n')
-                    raise ValueError()
-                npoints[nlines-1] = 1
-                point[nlines-1] = ik + 1
-            sys.stdout.write("high-symmetry point: {0:7.4f} {1:7.4f} {2:7.4f}".format(kpts[0,ik], kpts[1,ik], kpts[2,ik]))
-            sys.stdout.write(" x coordinate {0:9.4f}\n".format(kx_plot[ik]))
-        else:
-            # This k is not an high symmetry line so we just increase the number
-            # of points of this line.
-            npoints[nlines-1] = npoints[nlines-1] + 1
-
-    with open(gnu_file, 'w') as f:
-        if bandsdata["lsda"]:
-            f.write(f'# LSDA : nbnd_up, nbnd_dw = {bandsdata["nbnd_up"]} {bandsdata["nbnd_dw"]}\n')
-        for ib in range(nbnd):
-            for ik in range(nks):
-                f.write("{0:10.4f} {1:10.4f}\n".format(kx_plot[ik], bandsdata['band_energies'][ik,ib]))
-            f.write('\n')
+
+    high_sym_idx, kx_plot, segments = segment_kpath(kpts)
+    for ik in high_sym_idx:
+        sys.stdout.write("high-symmetry point: {0:7.4f} {1:7.4f} {2:7.4f}".format(kpts[0,ik], kpts[1,ik], kpts[2,ik]))
+        sys.stdout.write(" x coordinate {0:9.4f}\n".format(kx_plot[ik]))
+
+    header = None
+    if bandsdata["lsda"]:
+        header = f'# LSDA : nbnd_up, nbnd_dw = {bandsdata["nbnd_up"]} {bandsdata["nbnd_dw"]}\n'
+    write_plottable_bands(gnu_file, kx_plot, bandsdata['band_energies'], header)
 
     with open('xkplot.txt', 'w') as f:
-        for ik in range(nks):
-            f.write(f"{kx_plot[ik]:12.7f}\n")
+        f.write(("%12.7f\n" * nks) % tuple(kx_plot.tolist()))
 
-    return
+    if binary_file is not None:
+        # Same data without text formatting, read by plotband.py
+        arrays = {'kx': kx_plot, 'energy': bandsdata['band_energies'].T}
+        if bandsdata["lsda"]:
+            arrays['nbnd_up'] = bandsdata["nbnd_up"]
+            arrays['nbnd_dw'] = bandsdata["nbnd_dw"]
+        # plotband.py uses the .npz only while it matches gnu_file
+        arrays['source'] = np.array(json.dumps(source_stamp(gnu_file)))
+        # plotband.py may be writing the same file, so use a unique temporary name
+        binary_tmp = f'{binary_file}.tmp.{os.getpid()}.{os.urandom(4).hex()}'
+        with open(binary_tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(binary_tmp, binary_file)
 
+    return
 
+def write_plottable_bands(gnu_file, kx_plot, band_energies, header=None):
+    """
+    Write band energies (shape (nks, nbnd)) in the gnuplot format of bands.x.
+    The x column is formatted once, and each band is formatted with a single
+    %-operation and written as one block.
+    """
+    # x values are plain numbers, so they can be baked into the format string
+    band_fmt = "".join("{0:10.4f} %10.4f\n".format(x) for x in kx_plot.tolist()) + "\n"
+    with open(gnu_file, 'w', buffering=4*1024*1024) as f:
+        if header is not None:
+            f.write(header)
+        for ib in range(band_energies.shape[1]):
+            f.write(band_fmt % tuple(band_energies[:, ib].tolist()))
 
 if __name__ == "__main__":
     from time import localtime, strftime
@@ -183,6 +217,7 @@ if __name__ == "__main__":
     try:
         prefix = sys.argv[1]
         outdir = sys.argv[2]
+        write_binary = '--npz' in sys.argv[3:]
     except IndexError:
         sys.stdout.write("Input file is not given (The standard bands.x input file)\n")
         raise IndexError()
@@ -206,13 +241,14 @@ if __name__ == "__main__":
         sys.stdout.write("Error in xml file: file does not exist\n")
         raise ValueError()
     try:
-        bandsdata = parse_bandsdata(xml_file)
+        bandsdata = parse_bandsdata(xml_file, cache=True)
     except:
         sys.stdout.write("Error in reading xml file\n")
         raise ValueError()
 
     # Write high-symmetry k-points: the "poor man's algorithm" in bands.x
     gnu_file = os.path.join(filband+'.gnu')
-    punch_plottable_bands(bandsdata, gnu_file)
+    binary_file = gnu_file + '.npz' if write_binary else None
+    punch_plottable_bands(bandsdata, gnu_file, binary_file)
     sys.stdout.write("Plottable bands (eV) written to file {}\n".format(filband+'.gnu'))
 
@@ -4,20 +4,71 @@
 
 import sys
 import os.path
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
+from plotband import plot_bands
+from qe_parse_energy import load_cache, save_cache
 
-def get_nk(filename):
-    with open(filename, 'r') as f:
-        nk = 0
-        for line in f:
-            if line.strip() == "":
-                break
-            nk += 1
-    return nk
+def read_matdyn_freq(filename, modes=None):
+    """
+    Read the matdyn.x output filename (matdyn.freq.gp format: x and the
+    frequencies of all modes on each line). Return (xkplot, omega), where omega
+    has shape (nmodes, nk). modes is an optional slice of the 0-based mode
+    indices to return.
+
+    The text is parsed once and stored with one row per column of the file in
+    the parse cache of qe_parse_energy, which is used until filename changes.
+    The cache is memory-mapped, so only the rows of the selected modes are read.
+    """
+    cached = load_cache(filename, 'matdyn_freq')
+    if cached is not None:
+        meta, arrays = cached
+        data = arrays['data']
+    else:
+        with open(filename, "r") as f:
+            text = f.read()
+        ncol = len(text[:text.find("\n")].split())
+        data = np.fromstring(text, dtype=float, sep=" ")
+        if ncol < 2 or data.size % ncol != 0:
+            raise ValueError(f"Cannot parse {filename}: {data.size} numbers in lines of {ncol} columns")
+        data = np.ascontiguousarray(data.reshape((-1, ncol)).T)
+        try:
+            save_cache(filename, 'matdyn_freq', {}, {'data': data})
+        except OSError as e:
+            print(f"Warning: cannot write parse cache for {filename}: {e}", file=sys.stderr)
+    xkplot = data[0]
+    omega = data[1:]
+    if modes is not None:
+        omega = omega[modes]
+    return xkplot, omega
+
+def parse_modes(modes):
+    """
+    Parse the --modes argument: "N" for the lowest N modes, or "START:STOP" for
+    modes START to STOP, 1-based and inclusive. Either end of the range can be
+    omitted. Return a slice of 0-based mode indices.
+    """
+    if ":" not in modes:
+        start, stop = None, int(modes)
+    else:
+        start, stop = modes.split(":")
+        start = int(start) - 1 if start.strip() else None
+        stop = int(stop) if stop.strip() else None
+    if (start is not None and start < 0) or (stop is not None and stop < 1):
+        raise ValueError("modes are numbered from 1")
+    return slice(start, stop)
+
+parser = argparse.ArgumentParser(description="Plot phonon band structure obtained by matdyn.x")
+parser.add_argument("prefix", nargs="?")
+parser.add_argument("--downsample", action="store_true",
+                    help="Downsample dense bands to the figure resolution (resampled on zoom)")
+parser.add_argument("--modes", type=parse_modes,
+                    help="Plot only some modes: N for the lowest N, or START:STOP (1-based, inclusive)")
+args = parser.parse_args()
 
-if len(sys.argv) > 1:
-    prefix = sys.argv[1].strip()
+if args.prefix is not None:
+    prefix = args.prefix.strip()
 else:
     prefix = None
 
@@ -33,11 +84,11 @@ fig = plt.figure(figsize=(5, 4))
 ax = plt.gca()
 
 # Read band structure
-data = np.loadtxt(filename_matdyn)
-xkplot = data[:, 0]
-omega = data[:, 1:]
+xkplot, omega = read_matdyn_freq(filename_matdyn, args.modes)
 
-nk, nmodes = omega.shape
+nmodes, nk = omega.shape
+if nmodes == 0:
+    parser.error(f"--modes selects no modes of {filename_matdyn}")
 
 # Read high-symmetry k points
 high_sym_k = []
@@ -58,8 +109,7 @@ else:
 high_sym_label = ["$\Gamma$" if x.lower() in ['gamma', 'g'] else x for x in high_sym_label]
 high_sym_label = ["$\Sigma$" if x.lower() == 'sigma' else x for x in high_sym_label]
 
-for imode in range(nmodes):
-    ax.plot(xkplot, omega[:, imode], "k")
+plot_bands(ax, xkplot, omega, "k", downsample=args.downsample, keep_x=high_sym_k)
 
 if len(high_sym_k) > 0:
     ax.set_xticks(high_sym_k)
@@ -1,34 +1,211 @@
 #!/usr/bin/env python3
 
+import re
 import sys
+import json
 import os.path
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import matplotlib.pyplot as plt
+from tailscan import find_last_line
+from filestamp import source_stamp
 
-def get_nk(filename):
-    with open(filename, 'r') as f:
-        nk = 0
-        for line in f:
-            if line[0] == "#": continue
-            if line.strip() == "":
-                break
-            nk += 1
-    return nk
+# Blank line separating two bands
+_BLANK_LINE = re.compile(r'\n[ \t\r]*\n')
+
+def read_bands(filename):
+    """
+    Read bands in the Wannier90 _band.dat or the QE .bands.dat.gnu format:
+    (x, E) pairs of each band, bands separated by a blank line, with an optional
+    "# LSDA : nbnd_up, nbnd_dw = n1 n2" header line.
+    Return (xkplot, e, nbnd_up, nbnd_dw), where e has shape (nbnd, nk) and
+    nbnd_up, nbnd_dw are None if not LSDA.
+
+    The file is read once and decoded in a single call. The result is cached in
+    filename.npz together with the source_stamp of filename, as a JSON string,
+    and used as long as the stamp matches. my_qe_bands.py --npz writes the same file for
+    .bands.dat.gnu.
+    """
+    filename_npz = filename + ".npz"
+    try:
+        data = np.load(filename_npz)
+        if "source" in data.files and json.loads(str(data["source"])) == source_stamp(filename):
+            if "nbnd_up" in data.files:
+                nbnd_up, nbnd_dw = int(data["nbnd_up"]), int(data["nbnd_dw"])
+            else:
+                nbnd_up, nbnd_dw = None, None
+            return data["kx"], data["energy"], nbnd_up, nbnd_dw
+    except (OSError, ValueError):
+        pass # No cache or an unreadable one
+
+    # Stamp taken before reading, so a change while reading makes the cache stale
+    stamp = source_stamp(filename)
+    with open(filename, "r") as f:
+        text = f.read()
+
+    # Header lines. Read LSDA information if present.
+    nbnd_up, nbnd_dw = None, None
+    pos = 0
+    while text.startswith("#", pos):
+        end = text.find("\n", pos)
+        if end == -1:
+            end = len(text)
+        line = text[pos:end]
+        if "# LSDA" in line:
+            nbnd_up, nbnd_dw = [int(x) for x in line.split()[-2:]]
+        pos = end + 1
+
+    data = np.fromstring(text[pos:], dtype=float, sep=" ")
+    # Number of k points: number of lines before the first blank line
+    match = _BLANK_LINE.search(text, pos)
+    if match is None:
+        nk = data.size // 2
+    else:
+        nk = text.count("\n", pos, match.start()) + 1
+    if nk == 0 or data.size % (2 * nk) != 0:
+        raise ValueError(f"Cannot parse {filename}: {data.size} numbers for {nk} k points per band")
+    data = data.reshape((-1, nk, 2))
+    xkplot = data[0, :, 0]
+    e = data[:, :, 1]
+
+    arrays = {"kx": xkplot, "energy": e, "source": np.array(json.dumps(stamp))}
+    if nbnd_up is not None:
+        arrays["nbnd_up"] = nbnd_up
+        arrays["nbnd_dw"] = nbnd_dw
+    # Unique temporary name, since other processes may write the same cache
+    filename_tmp = f"{filename_npz}.tmp.{os.getpid()}.{os.urandom(4).hex()}"
+    try:
+        with open(filename_tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(filename_tmp, filename_npz)
+    except OSError:
+        # Cache is optional, e.g. in a read-only directory
+        if os.path.exists(filename_tmp):
+            os.remove(filename_tmp)
+    return xkplot, e, nbnd_up, nbnd_dw
+
+# Number of points of e processed at once by downsample_minmax
+_DOWNSAMPLE_BLOCK_SIZE = 2**20
+
+def downsample_minmax(xkplot, e, nbins, keep_x=()):
+    """
+    Select the points of bands e (shape (nbnd, nk)) to draw at a resolution of
+    nbins bins along xkplot (non-decreasing). In each bin, the first, last,
+    minimum and maximum points of each band are kept, which preserves the shape
+    of the curves at that resolution. The points next to each x in keep_x (e.g.
+    high-symmetry points) and both points of each jump (repeated x) are always kept.
+    Return a list with the sorted indices of the kept points of each band.
+    """
+    nbnd, nk = e.shape
+    edges = np.linspace(xkplot[0], xkplot[-1], nbins + 1)
+    starts = np.unique(np.searchsorted(xkplot, edges[:-1], side="left"))
+    starts = starts[starts < nk]
+    counts = np.diff(np.append(starts, nk))
+
+    ik_keep = np.searchsorted(xkplot, np.asarray(keep_x, dtype=float))
+    ik_jump = np.nonzero(np.diff(xkplot) == 0)[0]
+    ik_common = np.concatenate((starts, starts + counts - 1, ik_keep - 1, ik_keep, ik_jump, ik_jump + 1))
+    ik_common = np.unique(np.clip(ik_common, 0, nk - 1))
+
+    # First index of the minimum and maximum of each band in each bin. Bands are
+    # processed in blocks, so the temporaries stay small for large e.
+    ik = np.arange(nk)
+    nbnd_block = max(1, _DOWNSAMPLE_BLOCK_SIZE // nk)
+    ik_bands = []
+    for ib0 in range(0, nbnd, nbnd_block):
+        eb = np.asarray(e[ib0:ib0 + nbnd_block])
+        emin = np.repeat(np.minimum.reduceat(eb, starts, axis=1), counts, axis=1)
+        ik_min = np.minimum.reduceat(np.where(eb == emin, ik, nk), starts, axis=1)
+        del emin
+        emax = np.repeat(np.maximum.reduceat(eb, starts, axis=1), counts, axis=1)
+        ik_max = np.minimum.reduceat(np.where(eb == emax, ik, nk), starts, axis=1)
+        del emax
+        for ib in range(eb.shape[0]):
+            ik_band = np.union1d(ik_common, np.concatenate((ik_min[ib], ik_max[ib])))
+            ik_bands.append(ik_band[ik_band < nk])
+    return ik_bands
+
+def _join_bands(xkplot, e, ik_bands=None):
+    """Concatenate bands, or the selected points of each band, separated by NaN."""
+    if ik_bands is None:
+        nbnd, nk = e.shape
+        x = np.full((nbnd, nk + 1), np.nan)
+        x[:, :nk] = xkplot
+        y = np.full((nbnd, nk + 1), np.nan)
+        y[:, :nk] = e
+        return x.ravel(), y.ravel()
+    nan = np.array([np.nan])
+    x = np.concatenate([np.concatenate((xkplot[ik], nan)) for ik in ik_bands])
+    y = np.concatenate([np.concatenate((e[ib, ik], nan)) for ib, ik in enumerate(ik_bands)])
+    return x, y
+
+class DownsampledBands:
+    """
+    Keep a line drawn by plot_bands downsampled to the pixel width of the axes.
+    When the x range of the axes changes (e.g. zoom), the visible range is
+    resampled from the full data.
+    """
+    def __init__(self, ax, line, xkplot, e, keep_x=()):
+        self.line = line
+        self.xkplot = xkplot
+        self.e = e
+        self.keep_x = keep_x
+        ax.callbacks.connect("xlim_changed", lambda ax: self.update(ax))
+
+    def get_data(self, ax, xlim=None):
+        """Return the x and y data of the line for the given x range."""
+        nk = len(self.xkplot)
+        nbins = max(int(ax.get_window_extent().width), 1)
+        if xlim is None:
+            i0, i1 = 0, nk
+        else:
+            i0 = max(np.searchsorted(self.xkplot, min(xlim), side="left") - 1, 0)
+            i1 = min(np.searchsorted(self.xkplot, max(xlim), side="right") + 1, nk)
+        xkplot = self.xkplot[i0:i1]
+        e = self.e[:, i0:i1]
+        if i1 - i0 <= 4 * nbins:
+            return _join_bands(xkplot, e)
+        return _join_bands(xkplot, e, downsample_minmax(xkplot, e, nbins, self.keep_x))
+
+    def update(self, ax):
+        self.line.set_data(*self.get_data(ax, ax.get_xlim()))
+
+def plot_bands(ax, xkplot, e, *args, downsample=False, keep_x=(), **kwargs):
+    """
+    Plot all bands in e (shape (nbnd, nk)) against xkplot as one Line2D, with
+    the bands separated by NaN. This is much faster to draw than one line per
+    band. Other arguments are passed to ax.plot.
+    If downsample is True, only the points that matter at the pixel resolution
+    of the axes are drawn (see downsample_minmax and DownsampledBands). Points
+    at keep_x are always drawn.
+    """
+    if not downsample:
+        return ax.plot(*_join_bands(xkplot, e), *args, **kwargs)
+    xkplot = np.asarray(xkplot)
+    downsampler = DownsampledBands(ax, None, xkplot, e, keep_x)
+    lines = ax.plot(*downsampler.get_data(ax), *args, **kwargs)
+    downsampler.line = lines[0]
+    return lines
+
+_EFERMI_MARKERS = [
+    "highest occupied level",
+    "the Fermi energy is",
+    "highest occupied, lowest unoccupied level",
+]
 
 def parse_efermi_or_evbm(filename):
     # Return the last found value because when using hybrid functions, Fermi energy is
     # printed multiple times and the last one is the one for the converged bands.
-    out = None
-    with open(filename, 'r') as f:
-        for line in f:
-            if "highest occupied level" in line:
-                out = float(line.split()[-1]), None
-            if "the Fermi energy is" in line:
-                out = float(line.split()[-2]), None
-            if "highest occupied, lowest unoccupied level" in line:
-                out = float(line.split()[-2]), float(line.split()[-1])
-    return out
+    # The file is searched from the end, so only its tail is read.
+    line = find_last_line(filename, _EFERMI_MARKERS)
+    if line is None:
+        return None
+    if "highest occupied, lowest unoccupied level" in line:
+        return float(line.split()[-2]), float(line.split()[-1])
+    if "the Fermi energy is" in line:
+        return float(line.split()[-2]), None
+    return float(line.split()[-1]), None
 
 def merge_multiple_high_sym_labels(high_sym_k, high_sym_label):
     high_sym_k_new = [high_sym_k[0]]
@@ -44,78 +221,64 @@ def merge_multiple_high_sym_labels(high_sym_k, high_sym_label):
     return high_sym_k_new, high_sym_label_new
 
 
-# Parse input arguments
-if __name__ == "__main__":
-    parser=argparse.ArgumentParser()
-    parser.add_argument("prefix")
-    parser.add_argument("--pdf", action='store_true')
-    parser.add_argument("--png", action='store_true')
-    args = parser.parse_args()
-    prefix = args.prefix
-    write_pdf = args.pdf
-    write_png = args.png
+def get_input_files(prefix, directory="."):
+    """Return the names of the files read by plot_band_structure (which may not exist)."""
+    filenames = {
+        "w90": os.path.join(directory, f"{prefix}_band.dat"),
+        "pw": os.path.join(directory, f"{prefix}.bands.dat.gnu"),
+        "label": os.path.join(directory, f"{prefix}_band.labelinfo.dat"),
+        "label_pw": os.path.join(directory, "plotband.out"),
+        "scf": os.path.join(directory, "scf.out"),
+    }
+    # Try to append prefix to filename_label_pw
+    filename_label_pw_prefix = os.path.join(directory, f"{prefix}.plotband.out")
+    if (not os.path.isfile(filenames["label_pw"])) and os.path.isfile(filename_label_pw_prefix):
+        filenames["label_pw"] = filename_label_pw_prefix
+    return filenames
 
-    filename_w90 = f"{prefix}_band.dat"
-    filename_pw = f"{prefix}.bands.dat.gnu"
-    filename_label = f"{prefix}_band.labelinfo.dat"
-    filename_label_pw = f"plotband.out"
-    filename_scf = "scf.out"
+def get_output_files(prefix, directory=".", write_pdf=False, write_png=False):
+    filenames = []
+    if write_pdf:
+        filenames.append(os.path.join(directory, f"{prefix}_band.pdf"))
+    if write_png:
+        filenames.append(os.path.join(directory, f"{prefix}_band.png"))
+    return filenames
+
+def plot_band_structure(prefix, directory=".", downsample=False):
+    """
+    Plot DFT and Wannier90 bands of prefix from the files in directory. Return the figure.
+    If downsample is True, dense bands are downsampled to the resolution of the figure.
+    """
+    filenames = get_input_files(prefix, directory)
+    filename_w90 = filenames["w90"]
+    filename_pw = filenames["pw"]
+    filename_label = filenames["label"]
+    filename_label_pw = filenames["label_pw"]
+    filename_scf = filenames["scf"]
 
     fig, axes = plt.subplots(1, 2, figsize=(8, 4))
 
     # Wannier90 bands
     if os.path.isfile(filename_w90):
-        nk_w90 = get_nk(filename_w90)
-
-        data_w90 = np.loadtxt(filename_w90).reshape((-1, nk_w90, 2))
-        xkplot_w90 = data_w90[0, :, 0]
-        e_w90 = data_w90[:, :, 1]
-
-        for ax in axes:
-            for ib in range(e_w90.shape[0]):
-                lines = ax.plot(xkplot_w90, e_w90[ib, :], 'r--', label='W90' if ib==0 else None, zorder=3)
-            ax.set_xlim([min(xkplot_w90), max(xkplot_w90)])
+        xkplot_w90, e_w90, _, _ = read_bands(filename_w90)
     else:
         xkplot_w90 = [1.0]
+        e_w90 = None
 
     # DFT bands
     if os.path.isfile(filename_pw):
-        # Read LSDA information if present.
-        with open(filename_pw, "r") as f:
-            line = f.readline()
-            if "# LSDA" in line:
-                lsda = True
-                nbnd_up, nbnd_dw = [int(x) for x in line.split()[-2:]]
-            else:
-                lsda = False
-
-        nk_pw = get_nk(filename_pw)
-        data_pw = np.loadtxt(filename_pw).reshape((-1, nk_pw, 2))
-        xkplot_pw = data_pw[0, :, 0]
-        e_pw = data_pw[:, :, 1]
+        xkplot_pw, e_pw, nbnd_up, nbnd_dw = read_bands(filename_pw)
+        lsda = nbnd_up is not None
         xk_pw_to_w90_convert = xkplot_w90[-1] / xkplot_pw[-1]
-        xkplot_pw *= xk_pw_to_w90_convert
+        xkplot_pw = xkplot_pw * xk_pw_to_w90_convert
         nbnd = e_pw.shape[0]
-
-        for ax in axes:
-            if lsda:
-                for ib in range(nbnd_up):
-                    lines = ax.plot(xkplot_pw, e_pw[ib, :], 'k-', label='DFT spin up' if ib==0 else None, zorder=1)
-                for ib in range(nbnd_up, nbnd_up + nbnd_dw):
-                    lines = ax.plot(xkplot_pw, e_pw[ib, :], 'b-', label='DFT spin down' if ib==nbnd_up else None, zorder=1)
-            else:
-                for ib in range(nbnd):
-                    lines = ax.plot(xkplot_pw, e_pw[ib, :], 'k-', label='DFT' if ib==0 else None, zorder=1)
-            ax.set_xlim([min(xkplot_pw), max(xkplot_pw)])
+    else:
+        e_pw = None
 
     # Special k points
     high_sym_k = []
     high_sym_label = []
 
-    # Try to append prefix to filename_label_pw
-    if (not os.path.isfile(filename_label_pw)) and os.path.isfile(f"{prefix}.{filename_label_pw}"):
-        filename_label_pw = f"{prefix}.{filename_label_pw}"
-
     if os.path.isfile(filename_label):
         # Read high-symmetry k point labels from Wannier90 output
         with open(filename_label, 'r') as f:
@@ -146,6 +309,25 @@ if __name__ == "__main__":
     if high_sym_label:
         high_sym_k, high_sym_label = merge_multiple_high_sym_labels(high_sym_k, high_sym_label)
 
+    # Plot bands. With downsampling, the high-symmetry points are always drawn.
+    if e_w90 is not None:
+        for ax in axes:
+            lines = plot_bands(ax, xkplot_w90, e_w90, 'r--', label='W90', zorder=3,
+                               downsample=downsample, keep_x=high_sym_k)
+            ax.set_xlim([min(xkplot_w90), max(xkplot_w90)])
+
+    if e_pw is not None:
+        for ax in axes:
+            if lsda:
+                lines = plot_bands(ax, xkplot_pw, e_pw[:nbnd_up], 'k-', label='DFT spin up', zorder=1,
+                                   downsample=downsample, keep_x=high_sym_k)
+                lines = plot_bands(ax, xkplot_pw, e_pw[nbnd_up:nbnd_up + nbnd_dw], 'b-', label='DFT spin down', zorder=1,
+                                   downsample=downsample, keep_x=high_sym_k)
+            else:
+                lines = plot_bands(ax, xkplot_pw, e_pw, 'k-', label='DFT', zorder=1,
+                                   downsample=downsample, keep_x=high_sym_k)
+            ax.set_xlim([min(xkplot_pw), max(xkplot_pw)])
+
     if len(high_sym_k) > 0:
         for ax in axes:
             ax.set_xticks(high_sym_k)
@@ -168,8 +350,102 @@ if __name__ == "__main__":
 
     axes[0].set_ylabel("Energy (eV)")
     axes[0].legend()
-    if write_pdf:
-        plt.savefig(f"{prefix}_band.pdf")
-    if write_png:
-        plt.savefig(f"{prefix}_band.png")
+    return fig
+
+def is_up_to_date(prefix, directory=".", write_pdf=False, write_png=False):
+    """True if all requested figures exist and are newer than all input files."""
+    outputs = get_output_files(prefix, directory, write_pdf, write_png)
+    if not outputs or not all(os.path.isfile(f) for f in outputs):
+        return False
+    inputs = [f for f in get_input_files(prefix, directory).values() if os.path.isfile(f)]
+    if not inputs:
+        return False
+    return min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(f) for f in inputs)
+
+def find_prefix(directory):
+    """Find the prefix of the band files in directory."""
+    prefixes = set()
+    for filename in os.listdir(directory):
+        if filename.endswith(".bands.dat.gnu"):
+            prefixes.add(filename[:-len(".bands.dat.gnu")])
+        elif filename.endswith("_band.dat"):
+            prefixes.add(filename[:-len("_band.dat")])
+    if len(prefixes) != 1:
+        raise ValueError(f"Cannot determine prefix in {directory}: found {sorted(prefixes)}")
+    return prefixes.pop()
+
+def plot_batch_target(target, write_pdf, write_png, force=False, downsample=False):
+    """
+    Render the figures of one batch target, which is a prefix, directory/prefix,
+    or a directory with a single prefix. Return a status message.
+    """
+    if os.path.isdir(target):
+        directory, prefix = target, find_prefix(target)
+    else:
+        directory, prefix = os.path.split(target)
+        directory = directory or "."
+    filenames = get_input_files(prefix, directory)
+    if not (os.path.isfile(filenames["w90"]) or os.path.isfile(filenames["pw"])):
+        raise FileNotFoundError(f"No band files for prefix {prefix} in {directory}")
+    if not force and is_up_to_date(prefix, directory, write_pdf, write_png):
+        return "up to date"
+    fig = plot_band_structure(prefix, directory, downsample)
+    for filename in get_output_files(prefix, directory, write_pdf, write_png):
+        fig.savefig(filename)
+    plt.close(fig)
+    return "written"
+
+def _plot_batch_worker(target, write_pdf, write_png, force, downsample):
+    try:
+        return target, True, plot_batch_target(target, write_pdf, write_png, force, downsample)
+    except Exception as e:
+        return target, False, f"{type(e).__name__}: {e}"
+
+
+# Parse input arguments
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser()
+    parser.add_argument("prefix", nargs="+",
+                        help="Prefix. With --batch, any number of prefix, directory/prefix or directory")
+    parser.add_argument("--pdf", action='store_true')
+    parser.add_argument("--png", action='store_true')
+    parser.add_argument("--batch", action='store_true',
+                        help="Render all targets without display using a process pool")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of processes for --batch")
+    parser.add_argument("--force", action='store_true', help="With --batch, also render up-to-date figures")
+    parser.add_argument("--downsample", action='store_true',
+                        help="Downsample dense bands to the figure resolution (resampled on zoom)")
+    args = parser.parse_args()
+    write_pdf = args.pdf
+    write_png = args.png
+
+    if args.batch:
+        if not (write_pdf or write_png):
+            parser.error("--batch needs --pdf and/or --png")
+        # Non-interactive backend, no display needed
+        plt.switch_backend("Agg")
+        failed = []
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=plt.switch_backend, initargs=("Agg",)) as executor:
+            futures = [executor.submit(_plot_batch_worker, target, write_pdf, write_png,
+                                       args.force, args.downsample)
+                       for target in args.prefix]
+            for future in as_completed(futures):
+                target, success, message = future.result()
+                print(f"{target}: {message}")
+                if not success:
+                    failed.append((target, message))
+        if failed:
+            print(f"{len(failed)} of {len(args.prefix)} figures failed:")
+            for target, message in failed:
+                print(f"  {target}: {message}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(args.prefix) > 1:
+        parser.error("Multiple prefixes need --batch")
+    prefix = args.prefix[0]
+
+    fig = plot_band_structure(prefix, downsample=args.downsample)
+    for filename in get_output_files(prefix, ".", write_pdf, write_png):
+        plt.savefig(filename)
     plt.show()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Parse band energies of many Quantum ESPRESSO calculations in parallel.
+
+Each calculation is written with qe_parse_energy.write_bands to a folder in
+the output directory, and index.json in the output directory lists the
+metadata, band extrema and band edges of all calculations. A calculation
+that fails to parse, or whose worker process dies, does not stop the others;
+failures are reported at the end and listed in index.json.
+
+Usage:
+    qe_parse_batch.py 'screen/*/temp/*.save' [-j 16] [-o batch_bands]
+    qe_parse_batch.py --manifest calcs.txt
+
+Each positional argument is a glob pattern matching prefix.save folders or
+data-file-schema.xml files. The manifest has one "prefix outdir" pair per line.
+"""
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from qe_parse_energy import parse_energy, write_bands
+
+def find_calculations(patterns, manifest=None):
+    """Return a list of (prefix, outdir) from glob patterns and a manifest file."""
+    calcs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            path = path.rstrip('/')
+            if os.path.basename(path) == 'data-file-schema.xml':
+                path = os.path.dirname(path)
+            if not path.endswith('.save'):
+                print(f"Skipping {path}: not a prefix.save folder")
+                continue
+            prefix = os.path.basename(path)[:-len('.save')]
+            calcs.append((prefix, os.path.dirname(path) or '.'))
+    if manifest is not None:
+        with open(manifest, 'r') as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line == "":
+                    continue
+                prefix, outdir = line.split()
+                calcs.append((prefix, outdir))
+    return calcs
+
+def band_edges(energy, occupations):
+    """
+    Return (vbm, cbm) from the highest occupied and lowest unoccupied states,
+    using 0.5 as the occupation threshold. Either can be None.
+    """
+    occupied = occupations > 0.5
+    vbm = float(energy[occupied].max()) if occupied.any() else None
+    cbm = float(energy[~occupied].min()) if (~occupied).any() else None
+    return vbm, cbm
+
+def parse_one(prefix, outdir, output, cache=False):
+    """
+    Parse one calculation and return its index record. The parse cache of
+    qe_parse_energy is off by default, since write_bands already stores the result.
+    """
+    xmlfile = os.path.join(outdir, prefix + '.save', 'data-file-schema.xml')
+    record = {'prefix': prefix, 'outdir': outdir, 'xmlfile': xmlfile}
+    try:
+        is_lsda, nbnd, nk, weight, energy, occupations, xk = parse_energy(xmlfile, cache=cache)
+
+        key = hashlib.sha1(os.path.abspath(xmlfile).encode()).hexdigest()[:8]
+        dirname = f'{prefix}_{key}'
+        write_bands(os.path.join(output, dirname), is_lsda, nbnd, nk, weight, energy, occupations, xk)
+
+        vbm, cbm = band_edges(energy, occupations)
+        gap = max(cbm - vbm, 0.0) if vbm is not None and cbm is not None else None
+        record.update({
+            'status': 'ok',
+            'bands': dirname,
+            'lsda': bool(is_lsda),
+            'nbnd': int(nbnd),
+            'nk': int(nk),
+            'vbm': vbm,
+            'cbm': cbm,
+            'gap': gap,
+            'band_min': energy.min(axis=1).tolist(),
+            'band_max': energy.max(axis=1).tolist(),
+        })
+    except Exception as e:
+        record.update({
+            'status': 'failed',
+            'error': f"{type(e).__name__}: {e}",
+            'traceback': traceback.format_exc(),
+        })
+    return record
+
+def _parse_isolated(parse, prefix, outdir, output, cache):
+    """
+    Run parse in a child process of its own, so that a worker killed by the
+    system (e.g. out of memory) fails only this calculation.
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            return executor.submit(parse, prefix, outdir, output, cache).result()
+    except Exception as e:
+        return {
+            'prefix': prefix,
+            'outdir': outdir,
+            'xmlfile': os.path.join(outdir, prefix + '.save', 'data-file-schema.xml'),
+            'status': 'failed',
+            'error': f"{type(e).__name__}: {e}",
+            'traceback': traceback.format_exc(),
+        }
+
+def parse_all(calcs, output, workers, cache=False, parse=parse_one):
+    """
+    Parse the (prefix, outdir) pairs in calcs with up to workers calculations
+    at a time, each in its own process. Yield their records in the same order.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_parse_isolated, parse, prefix, outdir, output, cache) for prefix, outdir in calcs]
+        for future in futures:
+            yield future.result()
+
+def write_index(output, records):
+    """Write index.json in output from the records of parse_one, and return the index."""
+    index = {
+        'units': {'energy': 'Ha'},
+        'calculations': [r for r in records if r['status'] == 'ok'],
+        'failed': [r for r in records if r['status'] != 'ok'],
+    }
+    with open(os.path.join(output, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(os.path.join(output, 'index.json.tmp'), os.path.join(output, 'index.json'))
+    print(f"Index written to {os.path.join(output, 'index.json')}")
+    return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse band energies of many QE calculations in parallel')
+    parser.add_argument('patterns', nargs='*', help='Glob patterns of prefix.save folders or data-file-schema.xml files')
+    parser.add_argument('--manifest', help='File with one "prefix outdir" pair per line')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of cores)')
+    parser.add_argument('-o', '--output', default='batch_bands', help='Output directory (default: batch_bands)')
+    parser.add_argument('--cache', action='store_true', help='Also store each parse in the qe_parse_energy cache')
+    args = parser.parse_args()
+
+    calcs = find_calculations(args.patterns, args.manifest)
+    if not calcs:
+        parser.error('No calculations found')
+    print(f"Parsing {len(calcs)} calculations with {args.workers} workers")
+
+    os.makedirs(args.output, exist_ok=True)
+    records = []
+    try:
+        for record in parse_all(calcs, args.output, args.workers, args.cache):
+            records.append(record)
+            print(f"[{len(records)}/{len(calcs)}] {record['xmlfile']}: {record['status']}")
+    finally:
+        # Keep the results obtained so far even if the batch is interrupted
+        index = write_index(args.output, records)
+
+    if index['failed']:
+        print()
+        print(f"{len(index['failed'])} of {len(calcs)} calculations failed:")
+        for record in index['failed']:
+            print(f"  {record['xmlfile']}: {record['error']}")
+        sys.exit(1)
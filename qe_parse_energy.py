@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
+import shutil
+import hashlib
 import numpy as np
 import xml.etree.ElementTree as ET
+from filestamp import source_stamp
 
 def find_value_int(root, tag):
     for item in root.iter(tag):
@@ -12,50 +16,377 @@ def find_value_logical(root, tag):
     for item in root.iter(tag):
         return item.text.strip() in ['True', 'true', 'TRUE']
 
-def parse_energy(xmlfile):
-    tree = ET.parse(xmlfile)
-    root = tree.getroot()
+def text_to_array(text, count=-1):
+    """
+    Decode a whitespace-separated block of numbers into a 1D float array.
+    If count is not -1, only the first count numbers are decoded.
+    """
+    return np.fromstring(text, dtype=float, sep=' ', count=count)
 
-    is_lsda = find_value_logical(root, 'lsda')
+# Scalars read from the xml file before the first ks_energies node
+_HEADER_TAGS = ('lsda', 'nbnd', 'nbnd_up', 'nbnd_dw', 'nk', 'nks')
 
+def iterparse_ks_energies(xmlfile):
+    """
+    Incrementally parse xmlfile and yield (header, node) for each ks_energies
+    node. header is a dict with the text of the first occurrence of each tag in
+    _HEADER_TAGS. Each node is cleared and detached from the tree once the
+    consumer asks for the next one, so the full DOM is never built.
+    """
+    header = {}
+    parents = []
+    for event, elem in ET.iterparse(xmlfile, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag in _HEADER_TAGS:
+            header.setdefault(elem.tag, elem.text)
+        elif elem.tag == 'ks_energies':
+            yield header, elem
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+
+def parse_header(header):
+    """Return is_lsda, nbnd, nk from the header dict of iterparse_ks_energies."""
+    is_lsda = header['lsda'].strip() in ['True', 'true', 'TRUE']
     if is_lsda:
-        nbnd = find_value_int(root, 'nbnd_up')
-        nbnd += find_value_int(root, 'nbnd_dw')
+        nbnd = int(header['nbnd_up']) + int(header['nbnd_dw'])
+    else:
+        nbnd = int(header['nbnd'])
+    if 'nk' in header:
+        nk = int(header['nk'])
     else:
-        nbnd = find_value_int(root, 'nbnd')
+        nk = int(header['nks'])
+    return is_lsda, nbnd, nk
+
+# Sidecar cache of parsed arrays. Each entry is a folder of .npy files plus a
+# meta.json that records the size and mtime of the xml file it was parsed from.
+# Entries live in $QE_PARSE_CACHE_DIR if set, otherwise in a _parse_cache folder
+# next to the xml file. If $QE_PARSE_CACHE_MAX_MB is set, the least recently
+# used entries are evicted after each write to keep the folder below that size.
+_CACHE_DIRNAME = '_parse_cache'
+
+def get_cache_dir(xmlfile):
+    cache_dir = os.environ.get('QE_PARSE_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(xmlfile)), _CACHE_DIRNAME)
+    return cache_dir
+
+def _get_cache_entry(xmlfile, tag):
+    key = hashlib.sha1(os.path.abspath(xmlfile).encode()).hexdigest()[:16]
+    return os.path.join(get_cache_dir(xmlfile), f'{tag}_{key}')
+
+def _replace_dir(src, dst):
+    """
+    Publish the folder src as dst with renames. An existing dst is first renamed
+    to a hidden name and then removed, so the files are never rewritten in
+    place: processes that memory-mapped them keep reading the old data.
+    """
+    old = None
+    if os.path.exists(dst):
+        old = _get_temp_dirname(dst, 'old')
+        os.replace(dst, old)
+    try:
+        os.replace(src, dst)
+    except OSError:
+        # Another process published dst in the meantime, which is as good
+        shutil.rmtree(src, ignore_errors=True)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+def _get_temp_dirname(dirname, kind):
+    """Unique hidden name next to dirname, ignored by evict_cache."""
+    parent, basename = os.path.split(os.path.abspath(dirname))
+    return os.path.join(parent, f'.{basename}.{kind}.{os.getpid()}.{os.urandom(4).hex()}')
+
+def write_array_dir(dirname, meta, arrays):
+    """
+    Write arrays as uncompressed .npy files in dirname, plus meta.json with
+    meta and the array names. The folder is written under a temporary name and
+    then renamed to dirname, replacing any previous version as a whole.
+    """
+    tmpdir = _get_temp_dirname(dirname, 'tmp')
+    os.makedirs(tmpdir)
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmpdir, name + '.npy'), np.asarray(arr))
+        meta = dict(meta, arrays=list(arrays))
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        _replace_dir(tmpdir, dirname)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+def read_array_dir(dirname, mmap_mode='r'):
+    """Return (meta, arrays) written by write_array_dir. Arrays are memory-mapped."""
+    with open(os.path.join(dirname, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in meta.pop('arrays'):
+        arrays[name] = np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode)
+    return meta, arrays
+
+def load_cache(xmlfile, tag):
+    """
+    Return (meta, arrays) cached for xmlfile under tag, or None if there is no
+    entry or if xmlfile changed since the entry was written.
+    """
+    entry = _get_cache_entry(xmlfile, tag)
+    try:
+        meta, arrays = read_array_dir(entry)
+        if meta.pop('source') != source_stamp(xmlfile):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
     try:
-        nk = find_value_int(root, 'nk')
-    except KeyError:
-        nk = find_value_int(root, 'nks')
-
-    weight = np.zeros((nk,))
-    xk = np.zeros((3, nk))
-    energy = np.zeros((nbnd, nk))
-    occupations = np.zeros((nbnd, nk))
+        # Mark as recently used for evict_cache
+        os.utime(os.path.join(entry, 'meta.json'))
+    except OSError:
+        pass # Entry of another user in a shared cache, still valid
+    return meta, arrays
+
+def save_cache(xmlfile, tag, meta, arrays):
+    """Store meta and arrays parsed from xmlfile in the cache under tag."""
+    entry = _get_cache_entry(xmlfile, tag)
+    write_array_dir(entry, dict(meta, source=source_stamp(xmlfile)), arrays)
+    max_mb = os.environ.get('QE_PARSE_CACHE_MAX_MB')
+    if max_mb:
+        evict_cache(os.path.dirname(entry), float(max_mb) * 1024**2)
+
+def evict_cache(cache_dir, max_bytes):
+    """Remove least recently used entries of cache_dir until it is at most max_bytes."""
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir() or entry.name.startswith('.'):
+            # Entries being written or removed by write_array_dir
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        try:
+            last_used = os.stat(os.path.join(entry.path, 'meta.json')).st_mtime
+        except FileNotFoundError:
+            last_used = 0.0 # incomplete entry, remove first
+        entries.append((last_used, size, entry.path))
+        total += size
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+ENERGY_FIELDS = ('energy', 'occupations', 'xk', 'weight')
+
+def parse_energy(xmlfile, cache=False, band_range=None, kpoint_indices=None, fields=ENERGY_FIELDS):
+    """
+    Parse band energies from a QE data-file-schema.xml file.
+    The file is read with iterparse, so peak memory is set by the output arrays
+    rather than by the size of the xml tree.
+
+    band_range=(ib0, ib1) keeps bands ib0 to ib1-1 (0-based, of each spin for
+    LSDA), kpoint_indices keeps the listed k points (0-based, in the given
+    order), and fields lists the arrays to fill. Only the selected part of the
+    file is decoded, and parsing stops after the last requested k point. Arrays
+    not in fields are returned as None, and the returned nbnd and nk count the
+    selected bands (of both spins for LSDA) and k points.
+
+    If cache is True, the full result is stored in a sidecar cache (see
+    load_cache) and later calls return memory-mapped arrays until xmlfile
+    changes. A selective parse reads the cache but does not write it.
+    """
+    for field in fields:
+        if field not in ENERGY_FIELDS:
+            raise ValueError(f"Unknown field {field}, must be one of {ENERGY_FIELDS}")
+    is_full = band_range is None and kpoint_indices is None and set(fields) == set(ENERGY_FIELDS)
+
+    if cache:
+        cached = load_cache(xmlfile, 'energy')
+        if cached is not None:
+            meta, arrays = cached
+            return _select_energy(meta['is_lsda'], meta['nbnd'], meta['nk'], arrays,
+                                  band_range, kpoint_indices, fields)
+
+    out = _parse_energy(xmlfile, band_range, kpoint_indices, fields)
+
+    if cache and is_full:
+        is_lsda, nbnd, nk, weight, energy, occupations, xk = out
+        meta = {'is_lsda': is_lsda, 'nbnd': nbnd, 'nk': nk}
+        arrays = {'weight': weight, 'energy': energy, 'occupations': occupations, 'xk': xk}
+        try:
+            save_cache(xmlfile, 'energy', meta, arrays)
+        except OSError as e:
+            print(f"Warning: cannot write parse cache for {xmlfile}: {e}", file=sys.stderr)
+    return out
+
+def _get_band_range(band_range, nbnd_spin):
+    if band_range is None:
+        return 0, nbnd_spin
+    ib0, ib1 = band_range
+    if ib1 is None:
+        ib1 = nbnd_spin
+    if not 0 <= ib0 < ib1 <= nbnd_spin:
+        raise ValueError(f"Invalid band_range {band_range} for {nbnd_spin} bands")
+    return ib0, ib1
+
+def _get_kpoint_indices(kpoint_indices, nk):
+    if kpoint_indices is None:
+        return None
+    kpoint_indices = [int(ik) for ik in kpoint_indices]
+    for ik in kpoint_indices:
+        if not 0 <= ik < nk:
+            raise ValueError(f"Invalid k point index {ik} for {nk} k points")
+    if len(set(kpoint_indices)) != len(kpoint_indices):
+        raise ValueError("kpoint_indices must not have duplicates")
+    return kpoint_indices
+
+def _select_energy(is_lsda, nbnd, nk, arrays, band_range, kpoint_indices, fields):
+    """Apply the selection of parse_energy to full (possibly memory-mapped) arrays."""
+    nspin = 2 if is_lsda else 1
+    ib0, ib1 = _get_band_range(band_range, nbnd // nspin)
+    kpoint_indices = _get_kpoint_indices(kpoint_indices, nk)
+    ksel = slice(None) if kpoint_indices is None else kpoint_indices
+
+    out = dict.fromkeys(ENERGY_FIELDS)
+    for field in fields:
+        if field in ('energy', 'occupations'):
+            out[field] = arrays[field][ib0:ib1][:, ksel]
+        elif field == 'xk':
+            out[field] = arrays[field][:, ksel]
+        else:
+            out[field] = arrays[field][ksel]
+    if kpoint_indices is not None:
+        nk = len(kpoint_indices)
+    return (is_lsda, (ib1 - ib0) * nspin, nk, out['weight'], out['energy'],
+            out['occupations'], out['xk'])
+
+def _parse_energy(xmlfile, band_range=None, kpoint_indices=None, fields=ENERGY_FIELDS):
     ik = 0
-    for supitem in root.iter('ks_energies'):
-        for item in supitem.iter('k_point'):
-            weight[ik] += float(item.items()[0][1])
-            xk[:, ik] = [float(x) for x in item.text.split()]
-        for item in supitem.iter('eigenvalues'):
-            energy[:, ik] = [float(x) for x in item.text.split()]
-        for item in supitem.iter('occupations'):
-            occupations[:, ik] = [float(x) for x in item.text.split()]
+    nfound = 0
+    for header, supitem in iterparse_ks_energies(xmlfile):
+        if ik == 0:
+            is_lsda, nbnd_full, nk_full = parse_header(header)
+            nspin = 2 if is_lsda else 1
+            nbnd_spin = nbnd_full // nspin
+            ib0, ib1 = _get_band_range(band_range, nbnd_spin)
+            if is_lsda:
+                # Eigenvalues of spin up come before those of spin down
+                bsel = np.r_[ib0:ib1, nbnd_spin+ib0:nbnd_spin+ib1]
+                count = nbnd_spin + ib1
+            else:
+                bsel = slice(ib0, ib1)
+                count = ib1
+            nbnd = (ib1 - ib0) * nspin
+
+            kpoint_indices = _get_kpoint_indices(kpoint_indices, nk_full)
+            if kpoint_indices is None:
+                nk = nk_full
+                kpos = None
+            else:
+                nk = len(kpoint_indices)
+                kpos = {ik_: i for i, ik_ in enumerate(kpoint_indices)}
+
+            weight = np.zeros((nk,)) if 'weight' in fields else None
+            xk = np.zeros((3, nk)) if 'xk' in fields else None
+            energy = np.zeros((nbnd, nk)) if 'energy' in fields else None
+            occupations = np.zeros((nbnd, nk)) if 'occupations' in fields else None
+
+        if kpos is None:
+            i = ik
+        elif ik in kpos:
+            i = kpos[ik]
+        else:
+            ik += 1
+            continue
+
+        if weight is not None or xk is not None:
+            for item in supitem.iter('k_point'):
+                if weight is not None:
+                    weight[i] += float(item.items()[0][1])
+                if xk is not None:
+                    xk[:, i] = text_to_array(item.text)
+        if energy is not None:
+            for item in supitem.iter('eigenvalues'):
+                energy[:, i] = text_to_array(item.text, count)[bsel]
+        if occupations is not None:
+            for item in supitem.iter('occupations'):
+                occupations[:, i] = text_to_array(item.text, count)[bsel]
         ik += 1
-    assert ik == nk
+        nfound += 1
+        if nfound == nk:
+            break
+    if ik == 0:
+        raise ValueError(f"No ks_energies found in {xmlfile}")
+    if kpos is None:
+        assert ik == nk
+    else:
+        assert nfound == nk
 
     if is_lsda:
-        energy_lsda = np.zeros((nbnd//2, nk, 2))
-        energy_lsda[:,:,0] = energy[:nbnd//2,:]
-        energy_lsda[:,:,1] = energy[nbnd//2:,:]
-        occupations_lsda = np.zeros((nbnd//2, nk, 2))
-        occupations_lsda[:,:,0] = occupations[:nbnd//2,:]
-        occupations_lsda[:,:,1] = occupations[nbnd//2:,:]
+        if energy is not None:
+            energy_lsda = np.zeros((nbnd//2, nk, 2))
+            energy_lsda[:,:,0] = energy[:nbnd//2,:]
+            energy_lsda[:,:,1] = energy[nbnd//2:,:]
+            energy = energy_lsda
+        if occupations is not None:
+            occupations_lsda = np.zeros((nbnd//2, nk, 2))
+            occupations_lsda[:,:,0] = occupations[:nbnd//2,:]
+            occupations_lsda[:,:,1] = occupations[nbnd//2:,:]
+            occupations = occupations_lsda
 
-    if is_lsda:
-        return is_lsda, nbnd, nk, weight, energy_lsda, occupations_lsda, xk
-    else:
-        return is_lsda, nbnd, nk, weight, energy, occupations, xk
+    return is_lsda, nbnd, nk, weight, energy, occupations, xk
+
+# Units of the arrays written by write_bands
+_BANDS_UNITS = {'energy': 'Ha', 'xk': '2pi/alat'}
+
+def write_bands(dirname, is_lsda, nbnd, nk, weight, energy, occupations, xk):
+    """
+    Write the output of parse_energy as a folder of uncompressed .npy files
+    with a meta.json header, which open_bands reads with memory mapping.
+    An existing folder is replaced as a whole, so files of a previous run do
+    not linger and readers that still map the old arrays are not affected.
+    """
+    if os.path.isdir(dirname) and not os.path.exists(os.path.join(dirname, 'meta.json')):
+        raise FileExistsError(f'{dirname} exists and was not written by write_bands, not replacing it')
+    meta = {'lsda': bool(is_lsda), 'nbnd': int(nbnd), 'nk': int(nk), 'units': _BANDS_UNITS}
+    arrays = {'energy': energy, 'occupations': occupations, 'xk': xk, 'weight': weight}
+    write_array_dir(dirname, meta, arrays)
+
+class BandsFile:
+    """
+    Read-only access to band energies written by write_bands. Arrays are
+    memory-mapped, so only the pages that are indexed are read from disk.
+    energy has shape (nbnd, nk), or (nbnd/2, nk, 2) for LSDA.
+    """
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.meta, self.arrays = read_array_dir(path)
+        else:
+            # Compressed energy_and_xk_<prefix>.npz of older versions
+            data = np.load(path)
+            self.arrays = {k: data[k] for k in data.files}
+            energy = self.arrays['energy']
+            self.meta = {'lsda': energy.ndim == 3, 'nbnd': energy.shape[0] * (2 if energy.ndim == 3 else 1),
+                         'nk': energy.shape[1], 'units': _BANDS_UNITS}
+        self.is_lsda = self.meta['lsda']
+        self.nbnd = self.meta['nbnd']
+        self.nk = self.meta['nk']
+        self.energy = self.arrays['energy']
+        self.xk = self.arrays['xk']
+        self.weight = self.arrays.get('weight')
+        self.occupations = self.arrays.get('occupations')
+
+    def bands(self, ib0, ib1=None):
+        """Energies of bands ib0 to ib1-1 (0-based) at all k points."""
+        return self.energy[ib0:ib1]
+
+    def kslice(self, ik0, ik1=None, step=None):
+        """Energies of all bands at k points ik0 to ik1-1 (0-based)."""
+        return self.energy[:, ik0:ik1:step]
+
+def open_bands(path):
+    return BandsFile(path)
 
 if __name__ == '__main__':
     print(sys.argv)
@@ -69,11 +400,11 @@ if __name__ == '__main__':
     #xmlfile = outdir + '/' + prefix + '.xml'
     xmlfile = os.path.join(outdir, prefix + '.save', 'data-file-schema.xml')
 
-    is_lsda, nbnd, nk, weight, energy, occupations, xk = parse_energy(xmlfile)
+    is_lsda, nbnd, nk, weight, energy, occupations, xk = parse_energy(xmlfile, cache=True)
 
     print("Is LSDA calculation: ", is_lsda)
     print("number of bands: ", nbnd)
     print("number of k points: ", nk)
 
-    np.savez('energy_and_xk_' + prefix, energy=energy, xk=xk)
+    write_bands('energy_and_xk_' + prefix, is_lsda, nbnd, nk, weight, energy, occupations, xk)
     # np.save('xk_' + prefix, xk)
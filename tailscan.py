@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Find the last line of a file that contains a marker, by reading the file
+backward in chunks from the end. The cost depends on how far the match is
+from the end of the file, not on the file size, which matters for large
+output files on parallel filesystems.
+
+Usage: tailscan.py filename marker [marker ...]
+"""
+import os
+import sys
+
+def find_last_line(filename, markers, chunk_size=1024*1024):
+    """
+    Return the last line of filename (without the line ending) that contains
+    any of the strings in markers, or None if there is no such line.
+    """
+    markers = [m.encode() for m in markers]
+    with open(filename, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        # Partial line at the start of the previously read chunk
+        partial = b''
+        while pos > 0:
+            size = min(chunk_size, pos)
+            pos -= size
+            f.seek(pos)
+            buf = f.read(size) + partial
+
+            # Only search complete lines. The first line of buf is complete only
+            # at the start of the file.
+            if pos > 0:
+                istart = buf.find(b'\n') + 1
+                if istart == 0:
+                    partial = buf
+                    continue
+            else:
+                istart = 0
+
+            imatch = max(buf.rfind(m, istart) for m in markers)
+            if imatch >= 0:
+                line_start = buf.rfind(b'\n', 0, imatch) + 1
+                line_end = buf.find(b'\n', imatch)
+                if line_end == -1:
+                    line_end = len(buf)
+                return buf[line_start:line_end].decode(errors='replace').rstrip('\r')
+            partial = buf[:istart - 1] if istart > 0 else b''
+    return None
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    line = find_last_line(sys.argv[1], sys.argv[2:])
+    if line is None:
+        sys.exit(1)
+    print(line)
@@ -0,0 +1,16 @@
+import os
+from qe_parse_batch import parse_all
+
+def parse_or_die(prefix, outdir, output, cache):
+    """Stand-in for parse_one whose worker is killed for prefix 'killed'."""
+    if prefix == 'killed':
+        os._exit(9)
+    return {'prefix': prefix, 'outdir': outdir, 'xmlfile': prefix, 'status': 'ok'}
+
+def test_killed_worker_fails_only_its_calculation(tmp_path):
+    calcs = [(f'calc{i}', str(tmp_path)) for i in range(5)]
+    calcs.insert(2, ('killed', str(tmp_path)))
+    records = list(parse_all(calcs, str(tmp_path), workers=2, parse=parse_or_die))
+    assert [r['prefix'] for r in records] == [prefix for prefix, outdir in calcs]
+    assert [r['status'] for r in records] == ['ok', 'ok', 'failed', 'ok', 'ok', 'ok']
+    assert records[2]['error'].startswith('BrokenProcessPool')